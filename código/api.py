@@ -5,26 +5,157 @@ Guilherme Branco, aluno Nº 2020216924
 João Santos, aluno Nº 2020218995
 """
 
+import atexit
+import bisect
+import contextlib
+import cProfile
+import csv
+import hashlib
+import functools
+import io
+import json
+import os
+import queue
+import random
+import re
+import secrets
+import select
+import threading
+import time
+import uuid
 import flask
 import logging
+import logging.handlers
 import psycopg2
-from psycopg2 import sql
+import psycopg2.pool
+from psycopg2 import sql, errors
 import jwt
 from cryptography.fernet import Fernet
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
-app = flask.Flask(__name__)
-app.config['SECRET_KEY'] = 'stordenosvintefachavorpleaseplss'  # 32-character secure key
-app.config['SESSION_COOKIE_NAME'] = 'OUR-db-project'
-with open('key.txt', 'rb') as keyfile:
-    f = Fernet(keyfile.read())
+try:
+    import bcrypt
+except ImportError:
+    bcrypt = None
+
+# the endpoints are registered on the application made by create_app
+bp = flask.Blueprint('dbproj', __name__)
+logger = logging.getLogger('logger')
+slow_query_logger = logging.getLogger('slow_queries')
 
 StatusCodes = {
     'success': 200,
     'bad_request': 400,
-    'internal_error': 500
+    'too_many_requests': 429,
+    'internal_error': 500,
+    'service_unavailable': 503
+}
+
+# number of rows fetched from the server-side cursor (and written to the client) at a time when exporting
+EXPORT_CHUNK_ROWS = 2000
+
+# page sizes of the notification inbox
+INBOX_DEFAULT_LIMIT = 50
+INBOX_MAX_LIMIT = 200
+
+# seconds between keepalive comments sent to idle notification streams and between reconnection attempts
+# of the notifications listener, and maximum number of notifications waiting to be sent to a stream
+INBOX_STREAM_KEEPALIVE = 15
+INBOX_LISTEN_RETRY = 5
+INBOX_STREAM_QUEUE_SIZE = 100
+
+# maximum number of outbox events turned into notifications per transaction and seconds between outbox polls
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_POLL_INTERVAL = 1
+
+# seconds between refreshes of the campaign cache, and minimum seconds between the refreshes caused by
+# requests for campaigns that aren't in it
+CAMPAIGN_CACHE_REFRESH_INTERVAL = 60
+CAMPAIGN_CACHE_MISS_REFRESH = 5
+
+# seconds between runs of the expired coupons sweeper and maximum number of coupons it marks per transaction
+COUPON_SWEEP_INTERVAL = 300
+COUPON_SWEEP_BATCH_SIZE = 1000
+
+# page sizes and reply depths of the question threads
+QUESTIONS_DEFAULT_LIMIT = 20
+QUESTIONS_MAX_LIMIT = 100
+QUESTIONS_DEFAULT_DEPTH = 10
+QUESTIONS_MAX_DEPTH = 50
+
+# cost factor of the bcrypt password hashes (gen_salt('bf') uses 6) and threads hashing passwords
+BCRYPT_COST = 6
+PASSWORD_HASH_WORKERS = 4
+
+# default settings, each one can be replaced by the environment variable DBPROJ_<name> (see load_config):
+# DSN of the database (when empty, the encrypted password of projuser is decrypted with the key in KEY_PATH),
+# connections kept open and maximum connections of each api process, seconds a request waits for a free connection
+# and directory shared by the api processes to add up their metrics (see write_metrics). Statements that take
+# longer than SLOW_QUERY_MS milliseconds (0 to turn it off) are written to SLOW_QUERY_LOG, with their plan when
+# SLOW_QUERY_EXPLAIN is 'plan' (EXPLAIN) or 'analyze' (EXPLAIN ANALYZE, which runs the statement again). The spans
+# of TRACE_SAMPLE_RATE of the requests are written to TRACE_FILE (empty to turn tracing off). PROFILE_DIR is where
+# the profiles of the requests are written (empty to turn profiling off) and PROFILE_SAMPLE_RATE the fraction of
+# requests profiled without being asked to
+DEFAULT_CONFIG = {
+    'DSN': '',
+    'KEY_PATH': 'key.txt',
+    'POOL_MIN': 1,
+    'POOL_SIZE': 10,
+    'POOL_TIMEOUT': 30,
+    'INBOX_STREAMS': 20,
+    'SECRET_KEY': 'stordenosvintefachavorpleaseplss',  # 32-character secure key
+    'SESSION_COOKIE_NAME': 'OUR-db-project',
+    'LOG_FILE': 'log_file.log',
+    'METRICS_DIR': '',
+    'SLOW_QUERY_MS': 500,
+    'SLOW_QUERY_EXPLAIN': '',
+    'SLOW_QUERY_LOG': 'slow_queries.log',
+    'TRACE_FILE': '',
+    'TRACE_SAMPLE_RATE': 1.0,
+    'PROFILE_DIR': '',
+    'PROFILE_SAMPLE_RATE': 0.0
 }
 
+# upper bounds (seconds) of the buckets of the latency histograms, and seconds between the writes of the metrics
+# of each process to METRICS_DIR
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_WRITE_INTERVAL = 5
+
+# file of METRICS_DIR with the metrics of the worker processes that have exited, added up
+EXITED_METRICS_FILE = 'exited.json'
+
+# minimum seconds between two plans captured for the same slow statement, and maximum number of statements whose
+# last plan time is remembered (the least recently explained are forgotten)
+SLOW_QUERY_EXPLAIN_INTERVAL = 60
+SLOW_QUERY_EXPLAIN_MAX_STATEMENTS = 1000
+
+# kinds and status of the spans (OpenTelemetry values), seconds between the writes of the finished traces to
+# TRACE_FILE and maximum number of traces waiting to be written (the next ones are dropped)
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+SPAN_STATUS_ERROR = 2
+TRACE_EXPORT_INTERVAL = 1
+TRACE_QUEUE_SIZE = 10000
+
+# time during which a refresh token can be used to get a new access token, seconds between runs of the purge of
+# the expired refresh tokens and maximum number of tokens it deletes per transaction
+REFRESH_TOKEN_DURATION = timedelta(days=30)
+REFRESH_TOKEN_PURGE_INTERVAL = 3600
+REFRESH_TOKEN_PURGE_BATCH_SIZE = 1000
+
+# login attempts allowed in a burst and per second, per username and per client address, seconds a username or
+# address is blocked after its first failed login (doubled on each consecutive failure, up to the maximum)
+# and maximum number of usernames and addresses kept in memory
+LOGIN_USER_BUCKET_CAPACITY = 5
+LOGIN_USER_BUCKET_RATE = 0.2
+LOGIN_ADDRESS_BUCKET_CAPACITY = 30
+LOGIN_ADDRESS_BUCKET_RATE = 2
+LOGIN_BASE_BACKOFF = 1
+LOGIN_MAX_BACKOFF = 300
+LOGIN_THROTTLE_MAX_KEYS = 100000
+
 
 ##########################################################
 # EXCEPTIONS
@@ -40,11 +171,26 @@ class TokenCreationError(Exception):
         super(TokenCreationError, self).__init__(message)
 
 
+class InvalidRefreshToken(Exception):
+    def __init__(self, message='Invalid refresh token (it may be expired or already used, try logging in)'):
+        super(InvalidRefreshToken, self).__init__(message)
+
+
+class TooManyLoginAttempts(Exception):
+    def __init__(self, retry_after, message='Too many login attempts, try again in '):
+        super(TooManyLoginAttempts, self).__init__(message + f'{retry_after:.0f} seconds')
+
+
 class InvalidAuthenticationException(Exception):
     def __init__(self, message='Incorrect login information'):
         super(InvalidAuthenticationException, self).__init__(message)
 
 
+class UsernameAlreadyExists(Exception):
+    def __init__(self, username, message='Username already exists: '):
+        super(UsernameAlreadyExists, self).__init__(message + username)
+
+
 class InsufficientPrivilegesException(Exception):
     def __init__(self, privilege, extra_msg='', message='User must be '):
         super(InsufficientPrivilegesException, self).__init__(message + privilege + extra_msg)
@@ -115,28 +261,161 @@ class CouponExpired(Exception):
             message1 + str(c_id) + message2 + e_date + "' and today is '" + t_date + "'")
 
 
+##########################################################
+# TRACING
+##########################################################
+
+# Each request has a trace, kept in flask.g.trace: its id (the one of the W3C traceparent header, when given),
+# whether its spans are recorded, the ids of the open spans (the last one is the parent of new spans) and the
+# finished spans, which are exported to TRACE_FILE at the end of the request (see export_spans)
+def start_trace(traceparent):
+    parts = (traceparent or '').split('-')
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        trace_id, parent_id, sampled = parts[1], parts[2], parts[3] == '01'
+    else:
+        trace_id, parent_id = f'{random.getrandbits(128):032x}', ''
+        sampled = random.random() < settings['TRACE_SAMPLE_RATE']
+
+    flask.g.trace = {'trace_id': trace_id, 'recording': bool(settings['TRACE_FILE']) and sampled,
+                     'open': [parent_id], 'spans': []}
+    return flask.g.trace
+
+
+def current_trace():
+    if not flask.has_request_context():
+        return None
+
+    trace = flask.g.get('trace')
+    return trace if trace is not None and trace['recording'] else None
+
+
+def open_span(trace, name, kind, attributes):
+    span = {'spanId': f'{random.getrandbits(64):016x}', 'parentSpanId': trace['open'][-1], 'name': name,
+            'kind': kind, 'startTimeUnixNano': time.time_ns(), 'attributes': attributes}
+    trace['open'].append(span['spanId'])
+    return span
+
+
+def end_span(trace, span, error=None):
+    span['endTimeUnixNano'] = time.time_ns()
+    if error is not None:
+        span['status'] = {'code': SPAN_STATUS_ERROR, 'message': str(error)}
+
+    trace['open'].remove(span['spanId'])
+    trace['spans'].append(span)
+
+
+# Runs the body of the with statement in a span of the current request; does nothing when it isn't recorded
+@contextlib.contextmanager
+def traced(name, kind=SPAN_KIND_INTERNAL, **attributes):
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+
+    span = open_span(trace, name, kind, attributes)
+    try:
+        yield
+    except Exception as error:
+        end_span(trace, span, error)
+        raise
+    else:
+        end_span(trace, span)
+
+
+# Decorator that runs each call of the function in a span
+def traced_call(name, **attributes):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with traced(name, **attributes):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# triggers fired by each kind of statement, so that the time they add can be told apart in the traces
+statement_triggers = {
+    ('update', 'orders'): 'sale_notif_trig',
+    ('insert', 'ratings'): 'rating_notif_trig',
+    ('insert', 'questions'): 'q_notif_trig',
+    ('insert', 'notifications'): 'notif_push_trig',
+    ('insert', 'campaigns'): 'campaign_shards_trig'
+}
+
+statement_table = re.compile(r'\s*(?:insert\s+into|update|delete\s+from|lock\s+table|select\b.*?\bfrom)\s+(\w+)',
+                             re.IGNORECASE | re.DOTALL)
+# the changes made by a statement, including the ones in its CTEs (e.g. the order update of buy_products)
+statement_changes = re.compile(r'\b(insert)\s+into\s+(\w+)|\b(update)\s+(\w+)\s+set\b', re.IGNORECASE)
+
+
+def open_statement_span(cur, query):
+    trace = current_trace()
+    if trace is None:
+        return None, None
+
+    # the statement has the placeholders, not the values
+    statement = query.as_string(cur) if isinstance(query, sql.Composable) else query
+    if isinstance(statement, bytes):
+        statement = statement.decode()
+
+    operation = statement.split(None, 1)[0].lower() if statement.strip() else ''
+    match = statement_table.match(statement)
+    table = match.group(1).lower() if match else ''
+
+    attributes = {'db.system': 'postgresql', 'db.operation': operation, 'db.statement': statement}
+    if table:
+        attributes['db.sql.table'] = table
+
+    triggers = set()
+    for change in statement_changes.findall(statement):
+        key = (change[0] or change[2]).lower(), (change[1] or change[3]).lower()
+        if key in statement_triggers:
+            triggers.add(statement_triggers[key])
+    if triggers:
+        attributes['dbproj.triggers'] = ', '.join(sorted(triggers))
+
+    return trace, open_span(trace, f'{operation} {table}'.strip(), SPAN_KIND_CLIENT, attributes)
+
+
+def jsonify(response):
+    # the endpoints answer with HTTP 200 and the status in the body, kept for the request metrics and logs
+    if isinstance(response, dict) and flask.has_request_context():
+        flask.g.response_status = response.get('status')
+
+    with traced('json serialisation'):
+        return flask.jsonify(response)
+
+
 ##########################################################
 # AUXILIARY FUNCTIONS
 ##########################################################
 
+@traced_call('jwt decode')
 def get_user_id():
     try:
         header = flask.request.headers.get('Authorization')
         if header is None:
             raise jwt.exceptions.InvalidTokenError
 
-        user_token = jwt.decode(header.split(' ')[1], app.config['SECRET_KEY'],
-                                audience=app.config['SESSION_COOKIE_NAME'], algorithms=["HS256"])
+        user_token = jwt.decode(header.split(' ')[1], flask.current_app.config['SECRET_KEY'],
+                                audience=flask.current_app.config['SESSION_COOKIE_NAME'], algorithms=["HS256"])
 
     except jwt.exceptions.InvalidTokenError:
         raise TokenError()
 
+    # the user id is added to the log records of the request
+    flask.g.user_id = user_token['user']
     return user_token['user']
 
 
-def admin_check(fail_msg):
-    conn = db_connection()
-    cur = conn.cursor()
+@traced_call('role check', **{'dbproj.role': 'admin'})
+def admin_check(fail_msg, cur=None):
+    # on the cursor of the endpoint when given, so that a request doesn't hold a connection while waiting for another
+    conn = db_connection() if cur is None else None
+    cur = cur if cur is not None else conn.cursor()
     try:
         user_id = get_user_id()
 
@@ -154,14 +433,16 @@ def admin_check(fail_msg):
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return user_id
 
 
-def seller_check(fail_msg):
-    conn = db_connection()
-    cur = conn.cursor()
+@traced_call('role check', **{'dbproj.role': 'seller'})
+def seller_check(fail_msg, cur=None):
+    # on the cursor of the endpoint when given, so that a request doesn't hold a connection while waiting for another
+    conn = db_connection() if cur is None else None
+    cur = cur if cur is not None else conn.cursor()
     try:
         user_id = get_user_id()
 
@@ -179,14 +460,16 @@ def seller_check(fail_msg):
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return user_id
 
 
-def buyer_check(fail_msg):
-    conn = db_connection()
-    cur = conn.cursor()
+@traced_call('role check', **{'dbproj.role': 'buyer'})
+def buyer_check(fail_msg, cur=None):
+    # on the cursor of the endpoint when given, so that a request doesn't hold a connection while waiting for another
+    conn = db_connection() if cur is None else None
+    cur = cur if cur is not None else conn.cursor()
     try:
         user_id = get_user_id()
 
@@ -204,14 +487,16 @@ def buyer_check(fail_msg):
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return user_id
 
 
-def user_check(fail_msg):
-    conn = db_connection()
-    cur = conn.cursor()
+@traced_call('role check', **{'dbproj.role': 'user'})
+def user_check(fail_msg, cur=None):
+    # on the cursor of the endpoint when given, so that a request doesn't hold a connection while waiting for another
+    conn = db_connection() if cur is None else None
+    cur = cur if cur is not None else conn.cursor()
     try:
         user_id = get_user_id()
 
@@ -229,24 +514,1271 @@ def user_check(fail_msg):
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
     return user_id
 
 
+def create_auth_token(user_id):
+    config = flask.current_app.config
+
+    # create login token valid for 20 minutes
+    auth_token = jwt.encode({'user': user_id,
+                             'aud': config['SESSION_COOKIE_NAME'],
+                             'iat': datetime.utcnow(),
+                             'exp': datetime.utcnow() + timedelta(minutes=20)},
+                            config['SECRET_KEY'])
+
+    try:
+        # test token is not corrupted before returning login success
+        jwt.decode(auth_token, config['SECRET_KEY'], audience=config['SESSION_COOKIE_NAME'], algorithms=["HS256"])
+
+    except jwt.exceptions.InvalidTokenError:
+        raise TokenCreationError()
+
+    return auth_token
+
+
+def hash_refresh_token(refresh_token):
+    # refresh tokens are random, so a fast hash is enough to keep them unusable if the table leaks
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+
+def create_refresh_token(cur, user_id):
+    refresh_token = secrets.token_urlsafe(32)
+
+    statement = 'insert into refresh_tokens (token_hash, users_user_id, expires_at) values (%s, %s, %s);'
+    values = (hash_refresh_token(refresh_token), user_id, datetime.now(timezone.utc) + REFRESH_TOKEN_DURATION)
+    cur.execute(statement, values)
+
+    return refresh_token
+
+
+# bcrypt hashes are computed by a bounded pool of threads (the bcrypt package releases the GIL while hashing),
+# so that a burst of registrations doesn't take more cores than the pool's size
+password_hashers = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='password-hasher')
+
+
+def hash_password(cur, password):
+    if bcrypt is not None:
+        # '2a' is the bcrypt variant verified by pgcrypto's crypt(), used in the login
+        salt = bcrypt.gensalt(rounds=BCRYPT_COST, prefix=b'2a')
+        return password_hashers.submit(bcrypt.hashpw, password.encode(), salt).result().decode()
+
+    # without the bcrypt package the hash is computed by the database, in a statement of its own
+    cur.execute("select crypt(%s, gen_salt('bf', %s));", (password, BCRYPT_COST))
+    password_hash = cur.fetchone()[0]
+    cur.connection.commit()
+
+    return password_hash
+
+
+def inbox_cursor(row):
+    # a notification is identified in the inbox order by its time (in UTC) and id: <time>_<id>
+    notif_time = row[1].astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return f'{notif_time}_{row[0]}'
+
+
+def parse_inbox_cursor(cursor):
+    if cursor is None:
+        return None
+
+    notif_time, notification_id = cursor.split('_')
+    return datetime.strptime(notif_time, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc), int(notification_id)
+
+
+# New notifications are polled by id: the ids are committed in increasing order (see process_notification_outbox),
+# while a notification is dated with the time of its event, which can be earlier than notifications already read
+def parse_since_cursor(cursor):
+    if cursor is None:
+        return None
+
+    notification_id = int(cursor)
+    if notification_id < 0:
+        raise ValueError
+    return notification_id
+
+
+##########################################################
+# CONFIGURATION
+##########################################################
+
+def load_config(overrides=None):
+    config = {}
+    for name, default in DEFAULT_CONFIG.items():
+        value = os.environ.get(f'DBPROJ_{name}')
+        config[name] = default if value is None else type(default)(value)
+
+    config.update(overrides or {})
+    return config
+
+
+# settings of this process, also used outside of requests (background jobs and scripts)
+settings = load_config()
+
+
 ##########################################################
 # DATABASE ACCESS
 ##########################################################
-def db_connection():
-    db = psycopg2.connect(
+
+def database_dsn():
+    if settings['DSN']:
+        return settings['DSN']
+
+    # the key is only read when a connection is made, from the file given by DBPROJ_KEY_PATH
+    with open(settings['KEY_PATH'], 'rb') as keyfile:
+        f = Fernet(keyfile.read())
+
+    return psycopg2.extensions.make_dsn(
         user='projuser',
         password=f.decrypt(
             b'gAAAAABihXtn404Yx6-DxaYw99HjI_j9pcvteN0EP0a4ZKBzh_mDlp87vHr2NPwB-2u42JAONxCD-e-Mx0Ge8l6A_pnpeb1wdQ==').decode(),
         host='127.0.0.1',
         port='5432',
-        database='dbproj'
+        dbname='dbproj'
     )
-    return db
+
+
+# Cursor of the pooled connections: records a span for each statement, counts the statements executed and the time
+# spent on them (see record_query) and logs the slow ones (see log_slow_query)
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        trace, span = open_statement_span(self, query)
+        start = time.perf_counter()
+        error = None
+        try:
+            return super(InstrumentedCursor, self).execute(query, vars)
+        except Exception as execute_error:
+            error = execute_error
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            if span is not None:
+                end_span(trace, span, error)
+            record_query(seconds)
+            if 0 < settings['SLOW_QUERY_MS'] <= seconds * 1000:
+                log_slow_query(self, query, vars, seconds)
+
+
+# numbers (ids, quantities) are kept to reproduce the statement; text may be a password, a token or personal data
+def redact_parameter(value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return f'<{type(value).__name__}>'
+
+
+def redact_parameters(vars):
+    if vars is None:
+        return None
+    if isinstance(vars, dict):
+        return {name: redact_parameter(value) for name, value in vars.items()}
+    return [redact_parameter(value) for value in vars]
+
+
+last_explained = {}
+last_explained_lock = threading.Lock()
+
+# statements that EXPLAIN accepts; the others (e.g. a 'lock table' that waited for its lock) are logged without a plan
+explainable_statement = re.compile(r'\s*\(*\s*(select|insert|update|delete|with|values)\b', re.IGNORECASE)
+
+
+# Gets the plan of a slow statement with the same parameters, inside a savepoint that is always rolled back, so that
+# neither the changes made by EXPLAIN ANALYZE nor an error of the EXPLAIN affect the transaction of the request
+def explain_statement(conn, statement, vars):
+    now = time.monotonic()
+    with last_explained_lock:
+        if now - last_explained.get(statement, -SLOW_QUERY_EXPLAIN_INTERVAL) < SLOW_QUERY_EXPLAIN_INTERVAL:
+            return None
+        # moved to the end, so that the first ones are the least recently explained
+        last_explained.pop(statement, None)
+        last_explained[statement] = now
+        while len(last_explained) > SLOW_QUERY_EXPLAIN_MAX_STATEMENTS:
+            del last_explained[next(iter(last_explained))]
+
+    options = '(analyze, buffers) ' if settings['SLOW_QUERY_EXPLAIN'] == 'analyze' else ''
+    # a plain cursor, so the EXPLAIN itself isn't counted nor logged
+    cur = psycopg2.extensions.cursor(conn)
+
+    cur.execute('savepoint slow_query_explain;')
+    try:
+        cur.execute(f'explain {options}{statement}', vars)
+        return [row[0] for row in cur.fetchall()]
+    finally:
+        cur.execute('rollback to savepoint slow_query_explain;')
+        cur.close()
+
+
+def log_slow_query(cur, query, vars, seconds):
+    endpoint = current_endpoint()
+    metrics.increment('dbproj_slow_queries_total', (('endpoint', endpoint),))
+
+    try:
+        statement = query.as_string(cur) if isinstance(query, sql.Composable) else query
+        if isinstance(statement, bytes):
+            statement = statement.decode()
+
+        plan = None
+        explain_error = None
+        # named cursors only declare the cursor here, and a failed statement aborted the transaction (the pooled
+        # connections never are in autocommit, so a statement that succeeded left a transaction open)
+        if settings['SLOW_QUERY_EXPLAIN'] and cur.name is None and explainable_statement.match(statement) and \
+                cur.connection.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+            # the statement is logged without its plan when it can't be explained
+            try:
+                plan = explain_statement(cur.connection, statement, vars)
+            except (Exception, psycopg2.DatabaseError) as error:
+                explain_error = str(error).strip()
+
+        slow_query_logger.warning(json.dumps({'time': datetime.utcnow().isoformat() + 'Z', 'endpoint': endpoint,
+                                              'seconds': round(seconds, 6), 'statement': statement,
+                                              'parameters': redact_parameters(vars), 'plan': plan,
+                                              'explain_error': explain_error}, default=str))
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'Slow query log - error: {error}')
+
+
+# Connections of this process, shared by its threads and reused between requests. When all of them are in use,
+# db_connection waits up to <timeout> seconds for one to be released instead of failing right away
+class ConnectionPool:
+    def __init__(self, dsn, min_connections, max_connections, timeout):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(min_connections, max_connections, dsn,
+                                                         cursor_factory=InstrumentedCursor)
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.timeout = timeout
+
+    def get(self):
+        start = time.perf_counter()
+        acquired = self.slots.acquire(timeout=self.timeout)
+        metrics.observe('dbproj_pool_wait_seconds', (('endpoint', current_endpoint()),), time.perf_counter() - start)
+
+        if not acquired:
+            raise psycopg2.pool.PoolError(f'No database connection available after {self.timeout} seconds')
+
+        try:
+            return self.pool.getconn()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def put(self, conn):
+        # the connection goes back as it came out: no open transaction, read-write and not in autocommit
+        broken = conn.closed != 0
+        if not broken:
+            try:
+                conn.rollback()
+                conn.autocommit = False
+                conn.readonly = None
+            except psycopg2.Error:
+                broken = True
+
+        try:
+            self.pool.putconn(conn, close=broken)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        self.pool.closeall()
+
+
+# the pool is only made by the first connection of the process, so each gunicorn worker opens its own connections
+# (even when the application is loaded before forking the workers)
+pool = None
+pool_lock = threading.Lock()
+
+
+def db_connection():
+    global pool
+
+    with pool_lock:
+        if pool is None:
+            pool = ConnectionPool(database_dsn(), settings['POOL_MIN'], settings['POOL_SIZE'],
+                                  settings['POOL_TIMEOUT'])
+
+    return pool.get()
+
+
+def release_connection(conn):
+    pool.put(conn)
+
+
+# connection that isn't taken from the pool, for long-lived listeners and scripts; closed with conn.close()
+def dedicated_connection():
+    return psycopg2.connect(database_dsn())
+
+
+##########################################################
+# NOTIFICATIONS PUSH
+##########################################################
+
+# Listens to the 'inbox' channel, where the database publishes every notification created, with a single
+# connection shared by every client of the stream endpoint, and delivers each notification to its user's clients
+class InboxListener:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.streams = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    # returns None when this process already has INBOX_STREAMS open streams: each one holds a thread of the
+    # process for as long as its client stays connected
+    def subscribe(self, user_id):
+        notif_queue = queue.Queue(maxsize=INBOX_STREAM_QUEUE_SIZE)
+
+        with self.lock:
+            if self.streams >= settings['INBOX_STREAMS']:
+                return None
+            self.streams += 1
+            self.subscribers.setdefault(user_id, set()).add(notif_queue)
+
+            # the listening connection is only opened when the first client connects
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.listen, name='inbox-listener', daemon=True)
+                self.thread.start()
+
+        return notif_queue
+
+    def unsubscribe(self, user_id, notif_queue):
+        with self.lock:
+            queues = self.subscribers.get(user_id, set())
+            if notif_queue in queues:
+                self.streams -= 1
+            queues.discard(notif_queue)
+            if not queues:
+                self.subscribers.pop(user_id, None)
+
+    def dispatch(self, notification):
+        with self.lock:
+            queues = list(self.subscribers.get(notification['user_id'], ()))
+
+        for notif_queue in queues:
+            try:
+                notif_queue.put_nowait(notification)
+            except queue.Full:
+                # a client that doesn't keep up gets the notification when it reconnects
+                logger.warning(f'Notification stream of user {notification["user_id"]} is full, closing it')
+                self.close_stream(notif_queue)
+
+    # Ends a stream (its generator stops at the None); the client reconnects with the id of the last event it got
+    # (Last-Event-ID) and gets the notifications it missed from the database
+    @staticmethod
+    def close_stream(notif_queue):
+        while True:
+            try:
+                notif_queue.put_nowait(None)
+                return
+            except queue.Full:
+                # the notifications dropped are sent again after the reconnection
+                try:
+                    notif_queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def close_streams(self):
+        with self.lock:
+            queues = [notif_queue for queues in self.subscribers.values() for notif_queue in queues]
+
+        for notif_queue in queues:
+            self.close_stream(notif_queue)
+
+    def listen(self):
+        disconnected = False
+        while not self.stopped.is_set():
+            conn = None
+            try:
+                conn = dedicated_connection()
+                conn.set_session(autocommit=True)
+                conn.cursor().execute('listen inbox;')
+                logger.info('Listening for new notifications')
+
+                # the notifications published while the listener was disconnected were lost: the open streams are
+                # closed (now that no new one can be lost) so that their clients reconnect and get them
+                if disconnected:
+                    self.close_streams()
+                    disconnected = False
+
+                while not self.stopped.is_set():
+                    # wait for the connection to be readable, without holding the lock
+                    if select.select([conn], [], [], INBOX_STREAM_KEEPALIVE) == ([], [], []):
+                        continue
+
+                    conn.poll()
+                    while conn.notifies:
+                        payload = json.loads(conn.notifies.pop(0).payload)
+                        payload['cursor'] = str(payload['notification_id'])
+                        self.dispatch(payload)
+
+            except (Exception, psycopg2.DatabaseError) as error:
+                logger.error(f'Notification listener - error: {error}')
+                disconnected = True
+                self.stopped.wait(INBOX_LISTEN_RETRY)
+
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    # the listener ends within INBOX_STREAM_KEEPALIVE seconds
+    def stop(self):
+        self.stopped.set()
+
+
+inbox_listener = InboxListener()
+
+
+def latest_notification_id(user_id):
+    conn = db_connection()
+    conn.set_session(readonly=True)
+    cur = conn.cursor()
+
+    try:
+        cur.execute('select coalesce(max(notification_id), 0) from notifications where users_user_id = %s;',
+                    (user_id,))
+        latest = cur.fetchone()[0]
+        conn.commit()
+
+    finally:
+        release_connection(conn)
+
+    return latest
+
+
+# The notifications created after the id <since>, oldest first, read one page at a time, so that a client that
+# was disconnected for long gets all of them without a single large query
+def missed_notifications(user_id, since):
+    statement = 'select notification_id, notif_time, content ' \
+                'from notifications ' \
+                'where users_user_id = %s and notification_id > %s ' \
+                'order by notification_id limit %s;'
+
+    while True:
+        conn = db_connection()
+        conn.set_session(readonly=True)
+        cur = conn.cursor()
+
+        try:
+            cur.execute(statement, (user_id, since, INBOX_MAX_LIMIT))
+            rows = cur.fetchall()
+            conn.commit()
+
+        finally:
+            release_connection(conn)
+
+        for row in rows:
+            yield {'user_id': user_id, 'notification_id': row[0], 'notif_time': inbox_cursor(row).split('_')[0],
+                   'content': row[2], 'cursor': str(row[0])}
+
+        if len(rows) < INBOX_MAX_LIMIT:
+            return
+        since = rows[-1][0]
+
+
+##########################################################
+# BACKGROUND JOBS
+##########################################################
+
+# Runs <job> every <interval> seconds in a daemon thread; when the job returns True (there is more work pending)
+# it runs again right away
+class PeriodicWorker(threading.Thread):
+    def __init__(self, name, interval, job):
+        super(PeriodicWorker, self).__init__(name=name, daemon=True)
+        self.interval = interval
+        self.job = job
+        self.stopped = threading.Event()
+
+    def run(self):
+        logger.info(f'{self.name} started')
+        while not self.stopped.is_set():
+            try:
+                more_work = self.job()
+                metrics.increment('dbproj_background_runs_total', (('job', self.name), ('outcome', 'success')))
+            except (Exception, psycopg2.DatabaseError) as error:
+                logger.error(f'{self.name} - error: {error}')
+                metrics.increment('dbproj_background_runs_total', (('job', self.name), ('outcome', 'error')))
+                more_work = False
+
+            if not more_work:
+                self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+outbox_stats = {'batches': 0, 'events_processed': 0, 'last_batch_size': 0, 'last_batch_seconds': 0.0,
+                'last_batch_at': None}
+
+
+# Creates the notifications of a batch of pending outbox events; the events are only marked as processed
+# in the same transaction that creates their notifications, so every event is processed at least once
+def process_outbox():
+    conn = db_connection()
+    cur = conn.cursor()
+
+    try:
+        start = time.perf_counter()
+        cur.execute('select process_notification_outbox(%s);', (OUTBOX_BATCH_SIZE,))
+        processed = cur.fetchone()[0]
+        conn.commit()
+
+    except (Exception, psycopg2.DatabaseError):
+        conn.rollback()
+        raise
+
+    finally:
+        release_connection(conn)
+
+    if processed > 0:
+        outbox_stats['batches'] += 1
+        outbox_stats['events_processed'] += processed
+        outbox_stats['last_batch_size'] = processed
+        outbox_stats['last_batch_seconds'] = round(time.perf_counter() - start, 6)
+        outbox_stats['last_batch_at'] = datetime.utcnow()
+
+    return processed == OUTBOX_BATCH_SIZE
+
+
+outbox_worker = PeriodicWorker('outbox-worker', OUTBOX_POLL_INTERVAL, process_outbox)
+
+
+# Marks a batch of expired coupons (see expire_coupons)
+def sweep_expired_coupons():
+    conn = db_connection()
+    cur = conn.cursor()
+
+    try:
+        cur.execute('select expire_coupons(%s);', (COUPON_SWEEP_BATCH_SIZE,))
+        expired = cur.fetchone()[0]
+        conn.commit()
+
+    except (Exception, psycopg2.DatabaseError):
+        conn.rollback()
+        raise
+
+    finally:
+        release_connection(conn)
+
+    if expired > 0:
+        logger.info(f'Coupon sweeper - {expired} coupons expired')
+
+    return expired == COUPON_SWEEP_BATCH_SIZE
+
+
+coupon_sweeper = PeriodicWorker('coupon-sweeper', COUPON_SWEEP_INTERVAL, sweep_expired_coupons)
+
+
+# Deletes a batch of expired refresh tokens (see prune_refresh_tokens)
+def purge_refresh_tokens():
+    conn = db_connection()
+    cur = conn.cursor()
+
+    try:
+        cur.execute('select prune_refresh_tokens(%s);', (REFRESH_TOKEN_PURGE_BATCH_SIZE,))
+        deleted = cur.fetchone()[0]
+        conn.commit()
+
+    except (Exception, psycopg2.DatabaseError):
+        conn.rollback()
+        raise
+
+    finally:
+        release_connection(conn)
+
+    if deleted > 0:
+        logger.info(f'Refresh token purge - {deleted} tokens deleted')
+
+    return deleted == REFRESH_TOKEN_PURGE_BATCH_SIZE
+
+
+refresh_token_purger = PeriodicWorker('refresh-token-purger', REFRESH_TOKEN_PURGE_INTERVAL, purge_refresh_tokens)
+
+
+# finished traces waiting to be written by the trace exporter
+trace_queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+trace_stats = {'exported': 0, 'dropped': 0}
+
+
+def enqueue_trace(trace):
+    try:
+        trace_queue.put_nowait((trace['trace_id'], trace['spans']))
+    except queue.Full:
+        trace_stats['dropped'] += 1
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_span(trace_id, span):
+    otlp = {'traceId': trace_id, 'spanId': span['spanId'], 'parentSpanId': span['parentSpanId'], 'name': span['name'],
+            'kind': span['kind'], 'startTimeUnixNano': str(span['startTimeUnixNano']),
+            'endTimeUnixNano': str(span['endTimeUnixNano']),
+            'attributes': [{'key': key, 'value': otlp_value(value)} for key, value in span['attributes'].items()]}
+    if 'status' in span:
+        otlp['status'] = span['status']
+    return otlp
+
+
+# Writes the finished traces to TRACE_FILE, one per line in the OTLP/JSON format (the one read by the otlpjsonfile
+# receiver of the OpenTelemetry collector)
+def export_spans():
+    lines = []
+    while True:
+        try:
+            trace_id, spans = trace_queue.get_nowait()
+        except queue.Empty:
+            break
+
+        resource = {'attributes': [{'key': 'service.name', 'value': otlp_value('dbproj-api')},
+                                   {'key': 'process.pid', 'value': otlp_value(os.getpid())}]}
+        lines.append(json.dumps({'resourceSpans': [{
+            'resource': resource,
+            'scopeSpans': [{'scope': {'name': 'dbproj'}, 'spans': [otlp_span(trace_id, span) for span in spans]}]
+        }]}, default=str))
+
+    if lines:
+        # a single unbuffered write, so the lines of several processes don't get mixed
+        with open(settings['TRACE_FILE'], 'ab', buffering=0) as file:
+            file.write(('\n'.join(lines) + '\n').encode())
+        trace_stats['exported'] += len(lines)
+
+    return False
+
+
+trace_exporter = PeriodicWorker('trace-exporter', TRACE_EXPORT_INTERVAL, export_spans)
+
+
+##########################################################
+# METRICS
+##########################################################
+
+# descriptions of the metrics exposed by GET /metrics
+metrics_descriptions = {
+    'dbproj_requests_total': ('counter', 'Requests by endpoint, method and response status'),
+    'dbproj_request_duration_seconds': ('histogram', 'Time to produce the response of a request'),
+    'dbproj_db_duration_seconds': ('histogram', 'Time spent executing statements during a request'),
+    'dbproj_db_seconds_total': ('counter', 'Time spent executing statements (background includes the jobs)'),
+    'dbproj_db_queries_total': ('counter', 'Statements executed (background includes the jobs)'),
+    'dbproj_pool_wait_seconds': ('histogram', 'Time waiting for a connection of the pool'),
+    'dbproj_slow_queries_total': ('counter', 'Statements slower than the slow query threshold'),
+    'dbproj_login_throttle_total': ('counter', 'Login attempts allowed and rejected, and failed logins, by throttle'),
+    'dbproj_background_runs_total': ('counter', 'Runs of the background jobs, by job and outcome (success or error)')
+}
+
+
+# Counters and histograms of this process, identified by their name and labels (a tuple of (name, value) pairs).
+# Each histogram keeps the number of values in each bucket (not cumulative, the last one is +Inf) and their sum
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, labels, value=1):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {'counters': {name: [[list(labels), value] for labels, value in series.items()]
+                                 for name, series in self.counters.items()},
+                    'histograms': {name: [[list(labels), counts[:], total]
+                                          for labels, (counts, total) in series.items()]
+                                   for name, series in self.histograms.items()}}
+
+
+metrics = Metrics(METRICS_BUCKETS)
+
+# endpoint of the streamed response whose generator is running in this thread, after its request has finished
+stream_context = threading.local()
+
+
+def current_endpoint():
+    if not flask.has_request_context():
+        return getattr(stream_context, 'endpoint', None) or 'background'
+
+    # the endpoints of the blueprint are named 'dbproj.<function>'
+    return (flask.request.endpoint or 'not_found').split('.')[-1]
+
+
+def record_query(seconds):
+    if flask.has_request_context():
+        flask.g.db_seconds += seconds
+        flask.g.db_queries += 1
+    else:
+        labels = (('endpoint', current_endpoint()),)
+        metrics.increment('dbproj_db_seconds_total', labels, seconds)
+        metrics.increment('dbproj_db_queries_total', labels)
+
+
+# The generator of a streamed response runs after finish_request, outside of the request context: the statements
+# it executes are counted for the endpoint that returned it instead of the background jobs
+def streamed(generator):
+    endpoint = current_endpoint()
+
+    def wrapper():
+        stream_context.endpoint = endpoint
+        try:
+            yield from generator
+        finally:
+            stream_context.endpoint = None
+
+    return wrapper()
+
+
+def write_snapshot(path, snapshot):
+    with open(path + '.tmp', 'w') as file:
+        json.dump(snapshot, file)
+    # the file is replaced at once, readers never see half of it
+    os.replace(path + '.tmp', path)
+
+
+# With several api processes (gunicorn workers) each one writes its metrics to METRICS_DIR, and GET /metrics
+# adds up the metrics of all of them, so it doesn't matter which worker answers
+def write_metrics():
+    if not settings['METRICS_DIR']:
+        return False
+
+    write_snapshot(os.path.join(settings['METRICS_DIR'], f'{os.getpid()}.json'), metrics.snapshot())
+    return False
+
+
+# Called by the gunicorn master once a worker has exited (after its last write_metrics): the metrics of the worker
+# are added to the ones of the workers that exited before and its file is removed, so that METRICS_DIR doesn't
+# keep one file per worker ever started (nor adds up twice the file of a worker whose pid is reused)
+def merge_exited_metrics(pid):
+    if not settings['METRICS_DIR']:
+        return
+
+    path = os.path.join(settings['METRICS_DIR'], f'{pid}.json')
+    exited_path = os.path.join(settings['METRICS_DIR'], EXITED_METRICS_FILE)
+    if not os.path.exists(path):
+        return
+
+    snapshots = []
+    for file_path in (exited_path, path):
+        try:
+            with open(file_path) as file:
+                snapshots.append(json.load(file))
+        except (OSError, ValueError):
+            continue
+
+    counters, histograms = add_snapshots(snapshots)
+    write_snapshot(exited_path, {'counters': {name: [[list(labels), value] for labels, value in series.items()]
+                                              for name, series in counters.items()},
+                                 'histograms': {name: [[list(labels), counts, total]
+                                                       for labels, (counts, total) in series.items()]
+                                                for name, series in histograms.items()}})
+    os.remove(path)
+
+
+metrics_writer = PeriodicWorker('metrics-writer', METRICS_WRITE_INTERVAL, write_metrics)
+
+
+def collect_metrics():
+    if not settings['METRICS_DIR']:
+        return [metrics.snapshot()]
+
+    write_metrics()
+
+    snapshots = []
+    for file_name in os.listdir(settings['METRICS_DIR']):
+        if file_name.endswith('.json'):
+            try:
+                with open(os.path.join(settings['METRICS_DIR'], file_name)) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError):
+                # the process that wrote it may have just removed it
+                continue
+
+    return snapshots
+
+
+def format_labels(labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+# Adds up the counters and the histograms of the snapshots
+def add_snapshots(snapshots):
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, series in snapshot['counters'].items():
+            for labels, value in series:
+                labels = tuple(map(tuple, labels))
+                counters.setdefault(name, {})
+                counters[name][labels] = counters[name].get(labels, 0) + value
+
+        for name, series in snapshot['histograms'].items():
+            for labels, counts, total in series:
+                labels = tuple(map(tuple, labels))
+                histogram = histograms.setdefault(name, {}).setdefault(labels, [[0] * len(counts), 0.0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += total
+
+    return counters, histograms
+
+
+# Adds up the snapshots and writes them in the Prometheus text format
+def render_metrics(snapshots):
+    counters, histograms = add_snapshots(snapshots)
+
+    lines = []
+    for name, (metric_type, description) in metrics_descriptions.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {metric_type}')
+
+        for labels, value in sorted(counters.get(name, {}).items()):
+            lines.append(f'{name}{format_labels(labels)} {value}')
+
+        for labels, (counts, total) in sorted(histograms.get(name, {}).items()):
+            cumulative = 0
+            for bound, count in zip(list(METRICS_BUCKETS) + ['+Inf'], counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+
+    return '\n'.join(lines) + '\n'
+
+
+##########################################################
+# LOGGING
+##########################################################
+
+# attributes of the log records written to the log file, besides the time, level, logger, thread and message
+log_record_fields = ['request_id', 'trace_id', 'span_id', 'user_id', 'endpoint', 'elapsed_ms', 'status', 'duration_ms',
+                     'db_ms', 'db_queries']
+
+
+# Adds the request id, the trace and current span ids, the user id (once its token is decoded), the endpoint and
+# the milliseconds since the start of the request to the records logged during a request; it runs in the request
+# thread, before the record is queued
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        if flask.has_request_context() and 'request_id' in flask.g:
+            record.request_id = flask.g.request_id
+            record.trace_id = flask.g.trace['trace_id']
+            record.span_id = flask.g.trace['open'][-1] or None
+            record.user_id = flask.g.get('user_id')
+            record.endpoint = current_endpoint()
+            record.elapsed_ms = round((time.perf_counter() - flask.g.request_start) * 1000, 3)
+
+        return True
+
+
+# One JSON object per line
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                 'level': record.levelname, 'logger': record.name, 'thread': record.threadName,
+                 'message': record.getMessage()}
+
+        for field in log_record_fields:
+            if field in record.__dict__:
+                entry[field] = record.__dict__[field]
+
+        return json.dumps(entry, default=str)
+
+
+# The request threads only put their records in a queue (QueueHandler); the files and the console are written by
+# a listener thread of each process (QueueListener), so that logging never waits for I/O nor for handler locks
+log_listeners = []
+log_listeners_pid = None
+
+
+def setup_logging():
+    # the handlers are only added once per process, even if several applications are made
+    if logger.handlers:
+        return
+
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    queue_handler = logging.handlers.QueueHandler(queue.Queue())
+    queue_handler.addFilter(RequestContextFilter())
+    logger.addHandler(queue_handler)
+
+    # the slow statements go to their own file, already as JSON
+    slow_query_logger.addHandler(logging.handlers.QueueHandler(queue.Queue()))
+    slow_query_logger.propagate = False
+
+    start_log_listeners()
+    # the records still in the queues are written before the process exits
+    atexit.register(stop_log_listeners)
+
+
+def start_log_listeners():
+    global log_listeners_pid
+
+    # the listeners of the process that loaded the application have no thread in the workers forked from it
+    if log_listeners_pid == os.getpid():
+        return
+
+    file_handler = logging.FileHandler(settings['LOG_FILE'])
+    file_handler.setFormatter(JsonFormatter())
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+
+    # create formatter
+    formatter = logging.Formatter('%(asctime)s [%(levelname)s]:  %(message)s', '%H:%M:%S')
+    ch.setFormatter(formatter)
+
+    slow_query_handler = logging.FileHandler(settings['SLOW_QUERY_LOG'])
+    slow_query_handler.setFormatter(logging.Formatter('%(message)s'))
+
+    log_listeners.clear()
+    for target, handlers in ((logger, (file_handler, ch)), (slow_query_logger, (slow_query_handler,))):
+        # a new queue, the parent's one may have been in use when the process was forked
+        log_queue = queue.Queue()
+        for handler in target.handlers:
+            if isinstance(handler, logging.handlers.QueueHandler):
+                handler.queue = log_queue
+
+        listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        log_listeners.append(listener)
+
+    log_listeners_pid = os.getpid()
+
+
+def stop_log_listeners():
+    global log_listeners_pid
+
+    if log_listeners_pid == os.getpid():
+        for listener in log_listeners:
+            listener.stop()
+        log_listeners_pid = None
+
+
+##########################################################
+# PROFILING
+##########################################################
+
+# only one request of each process is profiled at a time (since Python 3.12 a single profiler can be active)
+profile_lock = threading.Lock()
+
+
+# A request is profiled when its X-Profile header has the token of an admin (the request itself can be made by any
+# user) or, with PROFILE_SAMPLE_RATE, at random. While PROFILE_DIR is empty nothing else is checked
+def profile_requested():
+    if not settings['PROFILE_DIR']:
+        return False
+
+    header = flask.request.headers.get('X-Profile')
+    if header is None:
+        return random.random() < settings['PROFILE_SAMPLE_RATE']
+
+    try:
+        token = jwt.decode(header.split(' ')[-1], flask.current_app.config['SECRET_KEY'],
+                           audience=flask.current_app.config['SESSION_COOKIE_NAME'], algorithms=["HS256"])
+    except jwt.exceptions.InvalidTokenError:
+        logger.warning(f'{flask.request.method} {flask.request.path} - invalid X-Profile token, not profiled')
+        return False
+
+    conn = db_connection()
+    cur = conn.cursor()
+
+    try:
+        cur.execute('select 1 from admins where users_user_id = %s;', (token['user'],))
+        admin = cur.fetchone() is not None
+        conn.commit()
+
+    finally:
+        release_connection(conn)
+
+    if not admin:
+        logger.warning(f'{flask.request.method} {flask.request.path} - X-Profile token of a non-admin, not profiled')
+
+    return admin
+
+
+def start_profile():
+    if not profile_requested():
+        return
+
+    if not profile_lock.acquire(blocking=False):
+        logger.info(f'{flask.request.method} {flask.request.path} - another request is being profiled, not profiled')
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # another profiling tool (e.g. a debugger) is in use
+        profile_lock.release()
+        return
+
+    flask.g.profiler = profiler
+
+
+# Writes the profile of the request in the pstats format (to be read with pstats, snakeviz or flameprof), named
+# after the time, the endpoint and the request id; the file name is returned in the X-Profile header
+def stop_profile(response):
+    profiler = flask.g.pop('profiler', None)
+    if profiler is None:
+        return
+
+    profiler.disable()
+    profile_lock.release()
+
+    file_name = f'{datetime.utcnow():%Y%m%dT%H%M%S}_{current_endpoint()}_{flask.g.request_id}.prof'
+    profiler.dump_stats(os.path.join(settings['PROFILE_DIR'], file_name))
+
+    response.headers['X-Profile'] = file_name
+    logger.info(f'{flask.request.method} {flask.request.path} - profile written to {file_name}')
+
+
+##########################################################
+# REQUEST HOOKS
+##########################################################
+
+@bp.before_app_request
+def start_request():
+    # the id given by a proxy is kept, so that its logs and ours can be matched
+    request_id = flask.request.headers.get('X-Request-ID', '')
+    if not request_id or len(request_id) > 64 or not request_id.replace('-', '').isalnum():
+        request_id = uuid.uuid4().hex
+
+    flask.g.request_id = request_id
+    flask.g.request_start = time.perf_counter()
+    flask.g.db_seconds = 0.0
+    flask.g.db_queries = 0
+
+    trace = start_trace(flask.request.headers.get('traceparent'))
+    if trace['recording']:
+        route = flask.request.url_rule.rule if flask.request.url_rule is not None else flask.request.path
+        flask.g.request_span = open_span(trace, f'{flask.request.method} {route}', SPAN_KIND_SERVER,
+                                         {'http.method': flask.request.method, 'http.route': route,
+                                          'dbproj.request_id': request_id})
+
+    # last, so that only the endpoint is profiled
+    start_profile()
+
+
+@bp.after_app_request
+def finish_request(response):
+    stop_profile(response)
+
+    endpoint = current_endpoint()
+    duration = time.perf_counter() - flask.g.request_start
+
+    # the status in the body recorded by jsonify, if any
+    status = flask.g.get('response_status') or response.status_code
+
+    labels = (('endpoint', endpoint),)
+    metrics.increment('dbproj_requests_total', labels + (('method', flask.request.method), ('status', str(status))))
+    metrics.observe('dbproj_request_duration_seconds', labels, duration)
+    metrics.observe('dbproj_db_duration_seconds', labels, flask.g.db_seconds)
+    metrics.increment('dbproj_db_seconds_total', labels, flask.g.db_seconds)
+    metrics.increment('dbproj_db_queries_total', labels, flask.g.db_queries)
+
+    logger.info(f'{flask.request.method} {flask.request.path} - {status} in {duration * 1000:.1f}ms',
+                extra={'status': status, 'duration_ms': round(duration * 1000, 3),
+                       'db_ms': round(flask.g.db_seconds * 1000, 3), 'db_queries': flask.g.db_queries})
+
+    trace = flask.g.trace
+    if trace['recording']:
+        request_span = flask.g.request_span
+        request_span['attributes']['http.status_code'] = status
+        if flask.g.get('user_id') is not None:
+            request_span['attributes']['enduser.id'] = flask.g.user_id
+        end_span(trace, request_span, f'status {status}' if isinstance(status, int) and status >= 500 else None)
+
+        # the spans of a streamed response, after this, aren't recorded
+        trace['recording'] = False
+        enqueue_trace(trace)
+
+    response.headers['X-Request-ID'] = flask.g.request_id
+    return response
+
+
+# a request that failed before finish_request still stops its profiler
+@bp.teardown_app_request
+def discard_profile(error):
+    profiler = flask.g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        profile_lock.release()
+
+
+##########################################################
+# CAMPAIGN CACHE
+##########################################################
+
+# In-process copy of the campaigns that are running or haven't started yet, used to reject subscriptions to
+# campaigns that don't exist or aren't running without going to the database; it is refreshed periodically
+# by the campaign-cache worker, after a campaign is created and when an unknown campaign is requested
+class CampaignCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.campaigns = {}
+        self.refreshed_at = None
+
+    def refresh(self):
+        conn = db_connection()
+        conn.set_session(readonly=True)
+        cur = conn.cursor()
+
+        statement = 'select campaign_id, description, date_start, date_end, discount ' \
+                    'from campaigns ' \
+                    'where date_end >= CURRENT_DATE;'
+
+        try:
+            cur.execute(statement)
+            rows = cur.fetchall()
+            conn.commit()
+
+        finally:
+            release_connection(conn)
+
+        campaigns = {r[0]: {'campaign_id': r[0], 'description': r[1], 'date_start': r[2], 'date_end': r[3],
+                            'discount': r[4]} for r in rows}
+
+        with self.lock:
+            self.campaigns = campaigns
+            self.refreshed_at = time.monotonic()
+
+        return False
+
+    def get(self, campaign_id):
+        with self.lock:
+            campaign = self.campaigns.get(campaign_id)
+            refreshed_at = self.refreshed_at
+
+        # the campaign may have been created by another api process: refresh, but not more than once in a while,
+        # so that requests for invalid ids don't turn into queries
+        if campaign is None and (refreshed_at is None
+                                 or time.monotonic() - refreshed_at > CAMPAIGN_CACHE_MISS_REFRESH):
+            self.refresh()
+            with self.lock:
+                campaign = self.campaigns.get(campaign_id)
+
+        return campaign
+
+    def is_running(self, campaign_id, day):
+        try:
+            campaign = self.get(int(campaign_id))
+        except ValueError:
+            return False
+        except (Exception, psycopg2.DatabaseError) as error:
+            # without the cache the database decides
+            logger.error(f'Campaign cache - error: {error}')
+            return True
+
+        return campaign is not None and campaign['date_start'] <= day <= campaign['date_end']
+
+    def listing(self, day):
+        if self.refreshed_at is None:
+            self.refresh()
+
+        with self.lock:
+            campaigns = sorted(self.campaigns.values(), key=lambda c: c['date_start'])
+
+        return {'active': [c for c in campaigns if c['date_start'] <= day <= c['date_end']],
+                'upcoming': [c for c in campaigns if c['date_start'] > day]}
+
+
+campaign_cache = CampaignCache()
+campaign_cache_worker = PeriodicWorker('campaign-cache', CAMPAIGN_CACHE_REFRESH_INTERVAL, campaign_cache.refresh)
+
+
+##########################################################
+# LOGIN THROTTLING
+##########################################################
+
+# Token buckets of login attempts, one per key (a username or a client address), kept in the memory of this process.
+# Each attempt takes a token, and tokens are given back at <rate> per second up to <capacity>; after <n> consecutive
+# failed logins the key is also blocked for base_backoff * 2^(n-1) seconds (up to max_backoff), and a successful login
+# resets the failures. Attempts rejected here never reach the database.
+class LoginThrottle:
+    def __init__(self, name, capacity, rate, base_backoff, max_backoff, max_keys):
+        self.name = name
+        self.capacity = capacity
+        self.rate = rate
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.keys = {}
+
+    def count(self, outcome):
+        metrics.increment('dbproj_login_throttle_total', (('throttle', self.name), ('outcome', outcome)))
+
+    def state(self, key, now):
+        key_state = self.keys.get(key)
+        if key_state is None:
+            # forget the oldest keys instead of growing without bound
+            if len(self.keys) >= self.max_keys:
+                for old_key in list(self.keys)[:len(self.keys) // 10 + 1]:
+                    del self.keys[old_key]
+            key_state = {'tokens': self.capacity, 'updated': now, 'failures': 0, 'blocked_until': 0.0}
+            self.keys[key] = key_state
+
+        key_state['tokens'] = min(self.capacity, key_state['tokens'] + (now - key_state['updated']) * self.rate)
+        key_state['updated'] = now
+        return key_state
+
+    # returns 0 if the attempt is allowed, otherwise the seconds to wait before trying again
+    def acquire(self, key):
+        now = time.monotonic()
+
+        with self.lock:
+            key_state = self.state(key, now)
+
+            if key_state['blocked_until'] > now:
+                self.count('rejected_backoff')
+                return key_state['blocked_until'] - now
+
+            if key_state['tokens'] < 1:
+                self.count('rejected_rate')
+                return (1 - key_state['tokens']) / self.rate
+
+            key_state['tokens'] -= 1
+            self.count('allowed')
+            return 0
+
+    def failure(self, key):
+        now = time.monotonic()
+
+        with self.lock:
+            key_state = self.state(key, now)
+            key_state['failures'] += 1
+            key_state['blocked_until'] = now + min(self.max_backoff,
+                                                   self.base_backoff * 2 ** (key_state['failures'] - 1))
+            self.count('failures')
+
+    def success(self, key):
+        with self.lock:
+            if key in self.keys:
+                self.keys[key]['failures'] = 0
+                self.keys[key]['blocked_until'] = 0.0
+
+
+# several users may share an address, so addresses get larger buckets than usernames
+login_throttles = {
+    'username': LoginThrottle('username', LOGIN_USER_BUCKET_CAPACITY, LOGIN_USER_BUCKET_RATE, LOGIN_BASE_BACKOFF,
+                              LOGIN_MAX_BACKOFF, LOGIN_THROTTLE_MAX_KEYS),
+    'address': LoginThrottle('address', LOGIN_ADDRESS_BUCKET_CAPACITY, LOGIN_ADDRESS_BUCKET_RATE, LOGIN_BASE_BACKOFF,
+                             LOGIN_MAX_BACKOFF, LOGIN_THROTTLE_MAX_KEYS)
+}
 
 
 ##########################################################
@@ -269,7 +1801,7 @@ columns_names = {
 # ENDPOINTS
 ##########################################################
 
-@app.route('/dbproj/')
+@bp.route('/dbproj/')
 def landing_page():
     return """
 
@@ -289,7 +1821,7 @@ def landing_page():
 ##
 # POST http://localhost:8080/dbproj/user
 ##
-@app.route('/dbproj/user/', methods=['POST'])
+@bp.route('/dbproj/user/', methods=['POST'])
 def register_user():
     logger.info('POST /dbproj/user/')
 
@@ -318,24 +1850,30 @@ def register_user():
 
     if len(required) > 0:
         response = {'status': StatusCodes['bad_request'], 'errors': required}
-        return flask.jsonify(response)
+        if conn is not None:
+            release_connection(conn)
+        return jsonify(response)
 
     try:
         # only admin user can register sellers and other admins
         if payload['type'] != 'buyers' and (payload['type'] == 'sellers' or payload['type'] == 'admins'):
-            admin_check(f" to register {payload['type']}")
+            admin_check(f" to register {payload['type']}", cur)
 
-        # lock the users table to ensure that
-        # no errors regarding the user id calculation occur in simultaneous user creation attempts
-        cur.execute('lock table users;')
+        # hash the password before the transaction starts, so that no lock is held while the (deliberately slow)
+        # bcrypt hash is computed
+        password_hash = hash_password(cur, payload['password'])
 
-        # Get new user_id
-        user_id_statement = 'select max(user_id) from users;'
-        cur.execute(user_id_statement)
-        rows = cur.fetchone()
-        user_id = rows[0] + 1  # user 0, first platform admin, is expected to always exist
+        # the user id comes from a sequence; a username that is already taken violates the users' unique constraint
+        statement = 'insert into users (username, password, email) values (%s, %s, %s) returning user_id;'
+        values = [payload['username'], password_hash, payload['email']]
+
+        try:
+            cur.execute(statement, values)
+        except errors.UniqueViolation:
+            raise UsernameAlreadyExists(payload['username'])
+
+        user_id = cur.fetchone()[0]
 
-        values = [user_id, payload['username'], payload['password'], payload['email']]
         type_values = [user_id]
 
         if payload['type'] == 'buyers':
@@ -345,19 +1883,16 @@ def register_user():
             type_values.append(payload['nif'])
             type_values.append(payload['shipping_addr'])
 
-        statement = f"insert into users values(%s, %s, crypt(%s, gen_salt('bf')), %s);"
-
         type_statement = psycopg2.sql.SQL('insert into {user_type} '
                                           'values(' + '%s, ' * (len(type_values) - 1) + ' %s);'
                                           ).format(user_type=sql.Identifier(payload['type']))
 
-        cur.execute(statement, values)
         cur.execute(type_statement, type_values)
 
         response = {'status': StatusCodes['success'], 'results': user_id}
         conn.commit()
 
-    except (TokenError, InsufficientPrivilegesException) as error:
+    except (TokenError, InsufficientPrivilegesException, UsernameAlreadyExists) as error:
         logger.error(f'POST /dbproj/user/ - error: {error}')
         response = {'status': StatusCodes['bad_request'], 'errors': str(error)}
         conn.rollback()
@@ -369,9 +1904,9 @@ def register_user():
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
-    return flask.jsonify(response)
+    return jsonify(response)
 
 
 ##
@@ -381,21 +1916,37 @@ def register_user():
 ##
 # PUT http://localhost:8080/dbproj/user
 ##
-@app.route('/dbproj/user', methods=['PUT'])
+@bp.route('/dbproj/user', methods=['PUT'])
 def login_user():
     logger.info('PUT /dbproj/user')
 
     payload = flask.request.get_json()
 
-    conn = db_connection()
-    conn.set_session(readonly=True)
-    cur = conn.cursor()
-
     # logger.debug(f'PUT /dbproj/user/ - payload: {payload}')
 
     if 'username' not in payload or 'password' not in payload:
         response = {'status': StatusCodes['bad_request'], 'errors': 'username and password are required for login'}
-        return flask.jsonify(response)
+        return jsonify(response)
+
+    # attempts are throttled per client address and per username before connecting to the database
+    # for the (expensive) password verification
+    throttle_keys = {'address': flask.request.remote_addr, 'username': str(payload['username'])}
+
+    try:
+        # stop at the first rejection, so that the attempts of a blocked address don't use up the tokens of the
+        # username it is trying
+        for kind, key in throttle_keys.items():
+            retry_after = login_throttles[kind].acquire(key)
+            if retry_after > 0:
+                raise TooManyLoginAttempts(retry_after)
+
+    except TooManyLoginAttempts as error:
+        logger.warning(f'PUT /dbproj/user {error}')
+        response = {'status': StatusCodes['too_many_requests'], 'errors': str(error)}
+        return jsonify(response)
+
+    conn = db_connection()
+    cur = conn.cursor()
 
     statement = 'select user_id, username from users where username = %s and password = crypt(%s, password);'
     values = (payload['username'], payload['password'])
@@ -404,26 +1955,20 @@ def login_user():
         cur.execute(statement, values)
         row = cur.fetchone()
 
-        if row is not None:
-            # create login token valid for 20 minutes
-            auth_token = jwt.encode({'user': row[0],
-                                     'aud': app.config['SESSION_COOKIE_NAME'],
-                                     'iat': datetime.utcnow(),
-                                     'exp': datetime.utcnow() + timedelta(minutes=20)},
-                                    app.config['SECRET_KEY'])
+        if row is None:
+            for kind, key in throttle_keys.items():
+                login_throttles[kind].failure(key)
+            raise InvalidAuthenticationException()
 
-            try:
-                # test token is not corrupted before returning login success
-                jwt.decode(auth_token, app.config['SECRET_KEY'], audience=app.config['SESSION_COOKIE_NAME'],
-                           algorithms=["HS256"])
+        for kind, key in throttle_keys.items():
+            login_throttles[kind].success(key)
 
-            except jwt.exceptions.InvalidTokenError:
-                raise TokenCreationError()
+        auth_token = create_auth_token(row[0])
 
-        else:
-            raise InvalidAuthenticationException()
+        # the refresh token gets new access tokens without verifying the password again
+        refresh_token = create_refresh_token(cur, row[0])
 
-        response = {'status': StatusCodes['success'], 'token': auth_token}
+        response = {'status': StatusCodes['success'], 'token': auth_token, 'refresh_token': refresh_token}
 
         conn.commit()
 
@@ -439,9 +1984,125 @@ def login_user():
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
+
+    return jsonify(response)
+
+
+##
+# Get a new access token (and a new refresh token) with a refresh token, without the password
+##
+# Each refresh token can only be used once; using a refresh token that was already used (rotated, not just
+# revoked by a logout) revokes every refresh token of the user, since it may have been stolen
+##
+# To use it, access through Postman:
+##
+# POST http://localhost:8080/dbproj/user/refresh
+##
+@bp.route('/dbproj/user/refresh', methods=['POST'])
+def refresh_login():
+    logger.info('POST /dbproj/user/refresh')
+
+    payload = flask.request.get_json()
+
+    if 'refresh_token' not in payload:
+        response = {'status': StatusCodes['bad_request'], 'errors': 'refresh_token is required'}
+        return jsonify(response)
+
+    conn = db_connection()
+    cur = conn.cursor()
+
+    token_hash = hash_refresh_token(payload['refresh_token'])
+
+    # use (rotate) the token, if it is still valid
+    use_statement = 'update refresh_tokens set revoked = true, rotated = true ' \
+                    'where token_hash = %s and not revoked and expires_at > CURRENT_TIMESTAMP ' \
+                    'returning users_user_id;'
+
+    revoke_user_statement = 'update refresh_tokens set revoked = true ' \
+                            'where not revoked and users_user_id = (select users_user_id from refresh_tokens ' \
+                            'where token_hash = %s and rotated);'
+
+    try:
+        cur.execute(use_statement, (token_hash,))
+        row = cur.fetchone()
+
+        if row is None:
+            # reuse of a rotated token: revoke the whole session of its user
+            cur.execute(revoke_user_statement, (token_hash,))
+            if cur.rowcount > 0:
+                logger.warning('POST /dbproj/user/refresh - reused refresh token, user sessions revoked')
+            conn.commit()
+            raise InvalidRefreshToken()
+
+        user_id = row[0]
+
+        response = {'status': StatusCodes['success'], 'token': create_auth_token(user_id),
+                    'refresh_token': create_refresh_token(cur, user_id)}
+        conn.commit()
+
+    except InvalidRefreshToken as error:
+        logger.error(f'POST /dbproj/user/refresh - error: {error}')
+        response = {'status': StatusCodes['bad_request'], 'errors': str(error)}
+        conn.rollback()
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'POST /dbproj/user/refresh - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        conn.rollback()
+
+    finally:
+        if conn is not None:
+            release_connection(conn)
+
+    return jsonify(response)
+
+
+##
+# Revoke a refresh token (logout)
+##
+# To use it, access through Postman:
+##
+# DELETE http://localhost:8080/dbproj/user/refresh
+##
+@bp.route('/dbproj/user/refresh', methods=['DELETE'])
+def revoke_refresh_token():
+    logger.info('DELETE /dbproj/user/refresh')
+
+    payload = flask.request.get_json()
+
+    if 'refresh_token' not in payload:
+        response = {'status': StatusCodes['bad_request'], 'errors': 'refresh_token is required'}
+        return jsonify(response)
+
+    conn = db_connection()
+    cur = conn.cursor()
+
+    statement = 'update refresh_tokens set revoked = true where token_hash = %s and not revoked;'
+
+    try:
+        cur.execute(statement, (hash_refresh_token(payload['refresh_token']),))
+        if cur.rowcount == 0:
+            raise InvalidRefreshToken()
+
+        response = {'status': StatusCodes['success']}
+        conn.commit()
+
+    except InvalidRefreshToken as error:
+        logger.error(f'DELETE /dbproj/user/refresh - error: {error}')
+        response = {'status': StatusCodes['bad_request'], 'errors': str(error)}
+        conn.rollback()
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'DELETE /dbproj/user/refresh - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        conn.rollback()
+
+    finally:
+        if conn is not None:
+            release_connection(conn)
 
-    return flask.jsonify(response)
+    return jsonify(response)
 
 
 ##
@@ -451,7 +2112,7 @@ def login_user():
 ##
 # POST http://localhost:8080/dbproj/product
 ##
-@app.route('/dbproj/product', methods=['POST'])
+@bp.route('/dbproj/product', methods=['POST'])
 def add_product():
     logger.info('POST /dbproj/product')
     payload = flask.request.get_json()
@@ -476,8 +2137,8 @@ def add_product():
             response = {'status': StatusCodes['bad_request'],
                         'results': f'{i} is required to add a product'}
             if conn is not None:
-                conn.close()
-            return flask.jsonify(response)
+                release_connection(conn)
+            return jsonify(response)
 
     product_type = payload['type']
 
@@ -487,7 +2148,7 @@ def add_product():
         cur.execute('lock table products;')
 
         # Get the seller id
-        seller_id = seller_check(" to add a new product")
+        seller_id = seller_check(" to add a new product", cur)
 
         # Get new product_id
         product_id_statement = 'select max(product_id) from products;'
@@ -512,7 +2173,7 @@ def add_product():
                 if j not in payload:
                     response = {'status': StatusCodes['bad_request'],
                                 'results': f'{j} is required to add a {product_type[:-1]}'}
-                    return flask.jsonify(response)
+                    return jsonify(response)
             product_type_statement = psycopg2.sql.SQL(
                 'insert into {product_type} ' +
                 f'values ({("%s, " * len(columns_names[product_type]))[:-2]});'
@@ -523,7 +2184,7 @@ def add_product():
 
         else:
             response = {'status': StatusCodes['bad_request'], 'results': 'Valid type is required to add a product'}
-            return flask.jsonify(response)
+            return jsonify(response)
 
         # Insert new product info to the one that corresponds to the same type of product
         cur.execute(product_type_statement, product_type_values)
@@ -546,9 +2207,9 @@ def add_product():
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
-    return flask.jsonify(response)
+    return jsonify(response)
 
 
 ##
@@ -558,7 +2219,7 @@ def add_product():
 ##
 # http://localhost:8080/dbproj/product/69420
 ##
-@app.route('/dbproj/product/<product_id>', methods=['PUT'])
+@bp.route('/dbproj/product/<product_id>', methods=['PUT'])
 def update_product(product_id):
     logger.info('PUT /dbproj/product/<product_id>')
     payload = flask.request.get_json()
@@ -573,7 +2234,7 @@ def update_product(product_id):
 
     try:
         # check if the user is a seller
-        seller_id = seller_check(" to update a product")
+        seller_id = seller_check(" to update a product", cur)
 
         type_statement = 'select gettype(%s, %s);'
         type_values = (product_id, seller_id)
@@ -588,9 +2249,7 @@ def update_product(product_id):
         for i in payload:
             if i not in columns_names['products'] and i not in columns_names[product_type]:
                 response = {'status': StatusCodes['bad_request'], 'results': f'{i} is not a valid attribute'}
-                if conn is not None:
-                    conn.close()
-                return flask.jsonify(response)
+                return jsonify(response)
 
         # get a list of the unchanged attributes of the product
         non_changed = list(set(columns_names[product_type] + columns_names['products']) - set(payload.keys()))
@@ -642,9 +2301,9 @@ def update_product(product_id):
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
-    return flask.jsonify(response)
+    return jsonify(response)
 
 
 ##
@@ -654,7 +2313,7 @@ def update_product(product_id):
 ##
 # http://localhost:8080/dbproj/order
 ##
-@app.route('/dbproj/order', methods=['POST'])
+@bp.route('/dbproj/order', methods=['POST'])
 def buy_products():
     logger.info('POST /dbproj/order')
     payload = flask.request.get_json()
@@ -668,8 +2327,8 @@ def buy_products():
     if len(payload) > 2:
         response = {'status': StatusCodes['bad_request'], 'results': 'Invalid number of fields in the payload'}
         if conn is not None:
-            conn.close()
-        return flask.jsonify(response)
+            release_connection(conn)
+        return jsonify(response)
 
     coupon_id = -1 if 'coupon' not in payload else payload['coupon']
     discount = 0
@@ -678,20 +2337,26 @@ def buy_products():
         response = {'status': StatusCodes['bad_request'],
                     'results': 'cart listing items and quantities is required to buy products'}
         if conn is not None:
-            conn.close()
-        return flask.jsonify(response)
+            release_connection(conn)
+        return jsonify(response)
 
     product_version_statement = 'select version, price, stock from products where product_id = %s and version = (select max(version) from products where product_id = %s);'
     product_quantities_statement = 'insert into product_quantities values (%s, %s, %s, %s);'
     product_stock_statement = 'update products set stock = %s where product_id = %s and version = %s;'
     order_statement = 'insert into orders (id, order_date, buyers_users_user_id, coupons_coupon_id, coupons_campaigns_campaign_id) values (%s, %s, %s, %s, %s);'
+    claim_coupon_statement = 'update coupons as c set used = true ' \
+                             'from campaigns as ca ' \
+                             'where c.coupon_id = %s and c.buyers_users_user_id = %s and not c.used and not c.expired ' \
+                             'and c.expiration_date > %s::date and ca.campaign_id = c.campaigns_campaign_id ' \
+                             'returning c.campaigns_campaign_id, ca.discount;'
+    coupon_state_statement = 'select used, expiration_date from coupons where coupon_id = %s and buyers_users_user_id = %s;'
 
     order_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     total_price = 0.0
 
     try:
         # Get the buyer id
-        buyer_id = buyer_check(" to perform an order")
+        buyer_id = buyer_check(" to perform an order", cur)
 
         # lock the products and orders tables to ensure that:
         # - deadlocks from 2 buyers simultaneously trying to retrieve products are avoided
@@ -708,28 +2373,26 @@ def buy_products():
         order_id = rows[0][0] + 1 if rows[0][0] is not None else 1
         order_values = (order_id, order_date, buyer_id, None, None)
 
-        if coupon_id != -1:
-            # Get the coupon discount and expiration date and the campaign id that is connected to the coupon with the coupon_id as <coupon_id>
-            campaign_statement = 'select campaigns_campaign_id, discount, expiration_date, used ' \
-                                 'from coupons, campaigns  ' \
-                                 'where coupon_id = %s and campaigns_campaign_id = campaign_id and buyers_users_user_id = %s;'
-            campaign_values = (coupon_id, buyer_id)
-            cur.execute(campaign_statement, campaign_values)
-            rows = cur.fetchall()
-
-            if len(rows) == 0:
-                raise CouponNotSubscribed(coupon_id)
-
-            if rows[0][3]:
-                raise CouponAlreadyUsed(coupon_id)
-
-            expiration_date = rows[0][2]
-            today_date = order_date[:-9]
-            if datetime.strptime(today_date, "%Y-%m-%d").date() >= expiration_date:
-                raise CouponExpired(coupon_id, expiration_date, today_date)
-
-            campaign_id = rows[0][0]
-            discount = rows[0][1]
+        if coupon_id != -1:
+            # Validate and claim the coupon in a single statement: it must belong to the buyer, not be used and not
+            # be expired; the row lock taken by the update prevents the coupon from being used by simultaneous orders
+            claim_coupon_values = (coupon_id, buyer_id, order_date)
+            cur.execute(claim_coupon_statement, claim_coupon_values)
+            row = cur.fetchone()
+
+            if row is None:
+                # find out why the coupon couldn't be claimed, to report it
+                cur.execute(coupon_state_statement, (coupon_id, buyer_id))
+                coupon_state = cur.fetchone()
+
+                if coupon_state is None:
+                    raise CouponNotSubscribed(coupon_id)
+                if coupon_state[0]:
+                    raise CouponAlreadyUsed(coupon_id)
+                raise CouponExpired(coupon_id, str(coupon_state[1]), order_date[:-9])
+
+            campaign_id = row[0]
+            discount = row[1]
 
             # Create order_values with campaign info
             order_values = tuple(list(order_values)[:-2]) + (coupon_id, campaign_id)
@@ -763,21 +2426,24 @@ def buy_products():
             cur.execute(product_stock_statement, product_stock_values)
 
         # Calculate total_price with the discount (0 if no coupon is applied to the order) and update order info
-        order_price_update_statement = 'update orders set price_total = %s - (%s * (%s / 100)) where id = %s;'
-        order_price_update_values = (total_price, total_price, discount, order_id,)
-        cur.execute(order_price_update_statement, order_price_update_values)
-
-        # Update coupon info
+        # (and, in the same statement, the discount applied by the coupon and the order it was used in)
         if coupon_id != -1:
-            coupon_statement = 'update coupons set used = true, discount_applied = %s * (%s / 100) where coupon_id = %s;'
-            coupon_values = (total_price, discount, coupon_id,)
-            cur.execute(coupon_statement, coupon_values)
+            order_price_update_statement = 'with applied_coupon as (' \
+                                           'update coupons set discount_applied = %s * (%s / 100), orders_id = %s ' \
+                                           'where coupon_id = %s and campaigns_campaign_id = %s) ' \
+                                           'update orders set price_total = %s - (%s * (%s / 100)) where id = %s;'
+            order_price_update_values = (total_price, discount, order_id, coupon_id, campaign_id,
+                                         total_price, total_price, discount, order_id,)
+        else:
+            order_price_update_statement = 'update orders set price_total = %s - (%s * (%s / 100)) where id = %s;'
+            order_price_update_values = (total_price, total_price, discount, order_id,)
+        cur.execute(order_price_update_statement, order_price_update_values)
 
         response = {'status': StatusCodes['success'], 'results': f'{order_id}'}
         conn.commit()
 
     except (TokenError, InsufficientPrivilegesException, ProductNotFound, ProductWithoutStockAvailable,
-            CouponNotSubscribed, CouponExpired) as error:
+            CouponNotSubscribed, CouponAlreadyUsed, CouponExpired) as error:
         logger.error(f'POST /dbproj/order - error: {error}')
         response = {'status': StatusCodes['bad_request'], 'errors': str(error)}
         conn.rollback()
@@ -789,9 +2455,9 @@ def buy_products():
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
-    return flask.jsonify(response)
+    return jsonify(response)
 
 
 ##
@@ -801,7 +2467,7 @@ def buy_products():
 ##
 # http://localhost:8080/dbproj/rating/69420
 ##
-@app.route('/dbproj/rating/<product_id>', methods=['POST'])
+@bp.route('/dbproj/rating/<product_id>', methods=['POST'])
 def give_rating_feedback(product_id):
     logger.info('POST /dbproj/rating/<product_id>')
     payload = flask.request.get_json()
@@ -815,7 +2481,9 @@ def give_rating_feedback(product_id):
     if len(payload) > 2:
         response = {'status': StatusCodes['bad_request'],
                     'results': 'Invalid number of fields in the payload; should be 2'}
-        return flask.jsonify(response)
+        if conn is not None:
+            release_connection(conn)
+        return jsonify(response)
 
     # Verification of the required fields to do a rating to a product
     for i in columns_names["ratings"][:2]:
@@ -823,19 +2491,19 @@ def give_rating_feedback(product_id):
             response = {'status': StatusCodes['bad_request'],
                         'results': f'{i} is required to rate a product'}
             if conn is not None:
-                conn.close()
-            return flask.jsonify(response)
+                release_connection(conn)
+            return jsonify(response)
 
     # A rating needs to be between 1 and 5 if not consider the request a bad one
     if not 1 <= payload['rating'] <= 5:
         response = {'status': StatusCodes['bad_request'], 'results': f'Product rating must be between 1 and 5'}
         if conn is not None:
-            conn.close()
-        return flask.jsonify(response)
+            release_connection(conn)
+        return jsonify(response)
 
     try:
         # Get the buyer id
-        buyer_id = buyer_check(" to rate a product")
+        buyer_id = buyer_check(" to rate a product", cur)
 
         # Get info about the product that will be rated (the one already bought)
         statement = 'select orders.id, product_quantities.products_version ' \
@@ -889,9 +2557,9 @@ def give_rating_feedback(product_id):
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
-    return flask.jsonify(response)
+    return jsonify(response)
 
 
 ##
@@ -905,8 +2573,8 @@ def give_rating_feedback(product_id):
 # Reply to a question:
 # POST http://localhost:8080/dbproj/<product_id>/<parents_question_id>
 ##
-@app.route('/dbproj/questions/<product_id>', methods=['POST'])
-@app.route('/dbproj/questions/<product_id>/<parents_question_id>', methods=['POST'])
+@bp.route('/dbproj/questions/<product_id>', methods=['POST'])
+@bp.route('/dbproj/questions/<product_id>/<parents_question_id>', methods=['POST'])
 def post_question(product_id=None, parents_question_id=None):
     if parents_question_id is None:
         logger.info('PUT /dbproj/questions/<product_id>')
@@ -928,27 +2596,27 @@ def post_question(product_id=None, parents_question_id=None):
     if 'question' not in payload:
         response = {'status': StatusCodes['bad_request'],
                     'results': 'question must be provided for posting about a product'}
-        return flask.jsonify(response)
+        if conn is not None:
+            release_connection(conn)
+        return jsonify(response)
 
     try:
-        # lock the questions table to ensure that no errors regarding the question id calculation occur in simultaneous question creation attempts
-        cur.execute('lock table questions;')
-
-        statement = 'select * from ' \
-                    '(select max(question_id) from questions where products_product_id = %s) as q_ids, ' \
-                    '(select max(version) from products where product_id = %s) as p_vers;'
-        cur.execute(statement, [product_id, product_id])
+        statement = 'select max(version) from products where product_id = %s;'
+        cur.execute(statement, [product_id])
         rows = cur.fetchone()
 
-        if rows[1] is None:
+        if rows[0] is None:
             raise ProductNotFound(product_id)
 
-        products_version = rows[1].strftime("%Y-%m-%d %H:%M:%S")
+        products_version = rows[0].strftime("%Y-%m-%d %H:%M:%S")
 
-        question_id = rows[0] + 1 if rows[0] is not None else 1
+        # questions are numbered per product by a counter row of the product (see next_question_id),
+        # so only questions about the same product wait for each other
+        cur.execute('select next_question_id(%s);', [product_id])
+        question_id = cur.fetchone()[0]
 
-        insert_question_values = [question_id, payload['question'], user_check(" to post a question about a product"),
-                                  product_id, products_version]
+        user_id = user_check(" to post a question about a product", cur)
+        insert_question_values = [question_id, payload['question'], user_id, product_id, products_version]
 
         if parents_question_id is not None:
 
@@ -986,9 +2654,98 @@ def post_question(product_id=None, parents_question_id=None):
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
+
+    return jsonify(response)
+
+
+##
+# Obtain the question threads of a product, as trees of questions and replies
+##
+# Optional query parameters:
+#   limit - maximum number of top-level questions returned (default 20, at most 100)
+#   after - 'next' of a previous page, to get the following top-level questions
+#   depth - maximum depth of the replies returned (default 10, at most 50)
+##
+# To use it, access through postman:
+##
+# GET http://localhost:8080/dbproj/questions/69420?limit=10
+##
+@bp.route('/dbproj/questions/<product_id>', methods=['GET'])
+def get_questions(product_id):
+    logger.info('GET /dbproj/questions/<product_id>')
+
+    try:
+        limit = int(flask.request.args.get('limit', QUESTIONS_DEFAULT_LIMIT))
+        after = int(flask.request.args.get('after', 0))
+        depth = int(flask.request.args.get('depth', QUESTIONS_DEFAULT_DEPTH))
+        if not 1 <= limit <= QUESTIONS_MAX_LIMIT or not 0 <= depth <= QUESTIONS_MAX_DEPTH:
+            raise ValueError
+    except ValueError:
+        response = {'status': StatusCodes['bad_request'],
+                    'errors': f'limit must be between 1 and {QUESTIONS_MAX_LIMIT}, depth between 0 and '
+                              f'{QUESTIONS_MAX_DEPTH} and after must be a question id'}
+        return jsonify(response)
+
+    conn = db_connection()
+    conn.set_session(readonly=True)
+    cur = conn.cursor()
+
+    # one page of top-level questions and their replies, up to <depth> levels down,
+    # following the (products_product_id, questions_question_id) index
+    statement = 'with recursive thread as (' \
+                '(select question_id, question_text, users_user_id, questions_question_id, 0 as depth ' \
+                'from questions ' \
+                'where products_product_id = %s and questions_question_id is null and question_id > %s ' \
+                'order by question_id ' \
+                'limit %s) ' \
+                'union all ' \
+                'select q.question_id, q.question_text, q.users_user_id, q.questions_question_id, t.depth + 1 ' \
+                'from questions as q ' \
+                'join thread as t on q.products_product_id = %s and q.questions_question_id = t.question_id ' \
+                'where t.depth < %s) ' \
+                'select question_id, question_text, users_user_id, questions_question_id, depth ' \
+                'from thread ' \
+                'order by depth, question_id;'
+    values = (product_id, after, limit, product_id, depth)
+
+    try:
+        user_check(" to get the questions about a product", cur)
+
+        cur.execute(statement, values)
+        rows = cur.fetchall()
+
+        # rows come ordered by depth, so every parent is seen before its replies
+        questions = {}
+        threads = []
+        for row in rows:
+            question = {'question_id': row[0], 'question': row[1], 'user_id': row[2], 'replies': []}
+            questions[row[0]] = question
+
+            if row[3] is None:
+                threads.append(question)
+            else:
+                questions[row[3]]['replies'].append(question)
+
+        response = {'status': StatusCodes['success'], 'results': threads,
+                    'next': threads[-1]['question_id'] if len(threads) == limit else None}
+        conn.commit()
+
+    except (TokenError, InsufficientPrivilegesException) as error:
+        logger.error(f'GET /dbproj/questions/<product_id> - error: {error}')
+        response = {'status': StatusCodes['bad_request'], 'errors': str(error)}
+        conn.rollback()
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /dbproj/questions/<product_id> - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        conn.rollback()
+
+    finally:
+        if conn is not None:
+            release_connection(conn)
 
-    return flask.jsonify(response)
+    return jsonify(response)
 
 
 ##
@@ -998,7 +2755,7 @@ def post_question(product_id=None, parents_question_id=None):
 ##
 # GET http://localhost:8080/dbproj/products/7390626
 ##
-@app.route('/dbproj/product/<product_id>', methods=['GET'])
+@bp.route('/dbproj/product/<product_id>', methods=['GET'])
 def get_product_info(product_id):
     logger.info('GET /dbproj/product/<product_id>')
 
@@ -1007,7 +2764,7 @@ def get_product_info(product_id):
     cur = conn.cursor()
 
     try:
-        user_check(" to get product info")
+        user_check(" to get product info", cur)
 
         # Get info about the product that have the product_id correspondent to the one given
         statement = 'select name, stock, description, ' \
@@ -1047,9 +2804,9 @@ def get_product_info(product_id):
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
-    return flask.jsonify(response)
+    return jsonify(response)
 
 
 ##
@@ -1059,7 +2816,7 @@ def get_product_info(product_id):
 ##
 # GET http://localhost:8080/dbproj/report/year
 ##
-@app.route('/dbproj/report/year', methods=['GET'])
+@bp.route('/dbproj/report/year', methods=['GET'])
 def get_stats():
     logger.info('GET /dbproj/report/year')
 
@@ -1073,7 +2830,7 @@ def get_stats():
                 'group by month;'
 
     try:
-        user_check(" to obtain sale stats")
+        user_check(" to obtain sale stats", cur)
 
         cur.execute(statement)
         rows = cur.fetchall()
@@ -1095,9 +2852,116 @@ def get_stats():
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
+
+    return jsonify(response)
+
+
+##
+# Export the orders placed between two dates (inclusive), one line per ordered product, as CSV or NDJSON
+##
+# The rows are read through a server-side cursor and streamed to the client in chunks,
+# so the memory used does not depend on the size of the export
+##
+# To use it, access through postman:
+##
+# GET http://localhost:8080/dbproj/report/orders?from=2022-01-01&to=2022-12-31&format=csv
+##
+@bp.route('/dbproj/report/orders', methods=['GET'])
+def export_orders():
+    logger.info('GET /dbproj/report/orders')
+
+    export_format = flask.request.args.get('format', 'csv')
+    date_from = flask.request.args.get('from')
+    date_to = flask.request.args.get('to')
+
+    if export_format not in ['csv', 'ndjson']:
+        response = {'status': StatusCodes['bad_request'], 'errors': 'format must be \'csv\' or \'ndjson\''}
+        return jsonify(response)
+
+    try:
+        date_from = datetime.strptime(date_from, "%Y-%m-%d").date()
+        date_to = datetime.strptime(date_to, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        response = {'status': StatusCodes['bad_request'], 'errors': 'from and to dates are required (YYYY-MM-DD)'}
+        return jsonify(response)
+
+    columns = ['order_id', 'order_date', 'buyer_id', 'price_total', 'coupon_id', 'campaign_id', 'discount_applied',
+               'product_id', 'product_version', 'quantity', 'price', 'seller_id']
+
+    statement = 'select o.id, o.order_date, o.buyers_users_user_id, o.price_total, ' \
+                'o.coupons_coupon_id, o.coupons_campaigns_campaign_id, c.discount_applied, ' \
+                'pq.products_product_id, pq.products_version, pq.quantity, p.price, p.sellers_users_user_id ' \
+                'from orders as o ' \
+                'join product_quantities as pq on pq.orders_id = o.id ' \
+                'join products as p on p.product_id = pq.products_product_id and p.version = pq.products_version ' \
+                'left join coupons as c on c.coupon_id = o.coupons_coupon_id ' \
+                'and c.campaigns_campaign_id = o.coupons_campaigns_campaign_id ' \
+                'where o.order_date between %s and %s ' \
+                'order by o.id;'
+    values = (date_from, date_to)
+
+    conn = db_connection()
+    conn.set_session(readonly=True)
+
+    # named cursors live on the server, only itersize rows are transferred at a time
+    cur = conn.cursor(name='orders_export')
+    cur.itersize = EXPORT_CHUNK_ROWS
+
+    try:
+        admin_check(" to export orders", conn.cursor())
+
+        cur.execute(statement, values)
+
+    except (TokenError, InsufficientPrivilegesException) as error:
+        logger.error(f'GET /dbproj/report/orders - error: {error}')
+        response = {'status': StatusCodes['bad_request'], 'errors': str(error)}
+        release_connection(conn)
+        return jsonify(response)
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /dbproj/report/orders - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        release_connection(conn)
+        return jsonify(response)
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == 'csv':
+            writer.writerow(columns)
+
+        try:
+            rows = 0
+            for row in cur:
+                if export_format == 'csv':
+                    writer.writerow(row)
+                else:
+                    buffer.write(json.dumps(dict(zip(columns, row)), default=str) + '\n')
+
+                rows += 1
+                if rows % EXPORT_CHUNK_ROWS == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
 
-    return flask.jsonify(response)
+            yield buffer.getvalue()
+            conn.commit()
+            logger.info(f'GET /dbproj/report/orders - exported {rows} rows')
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            # the response has already started, so the error can only be logged
+            logger.error(f'GET /dbproj/report/orders - error: {error}')
+            conn.rollback()
+
+        finally:
+            release_connection(conn)
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    filename = f'orders_{date_from}_{date_to}.{export_format}'
+
+    return flask.Response(streamed(generate()), mimetype=mimetype,
+                          headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 
 ##
@@ -1107,7 +2971,7 @@ def get_stats():
 ##
 # GET http://localhost:8080/dbproj/campaign/
 ##
-@app.route('/dbproj/campaign/', methods=['POST'])
+@bp.route('/dbproj/campaign/', methods=['POST'])
 def add_campaign():
     logger.info('POST /dbproj/campaign/')
     payload = flask.request.get_json()
@@ -1123,54 +2987,49 @@ def add_campaign():
             response = {'status': StatusCodes['bad_request'],
                         'errors': f'{i} is not a valid attribute'}
             if conn is not None:
-                conn.close()
-            return flask.jsonify(response)
+                release_connection(conn)
+            return jsonify(response)
     for i in range(1, 6):
         if columns_names['campaigns'][i] not in payload:
             response = {'status': StatusCodes['bad_request'],
                         'errors': f'{columns_names["campaigns"][i]} value not in payload'}
             if conn is not None:
-                conn.close()
-            return flask.jsonify(response)
+                release_connection(conn)
+            return jsonify(response)
 
     if datetime.strptime(payload['date_start'], "%Y-%m-%d") > datetime.strptime(payload['date_end'], "%Y-%m-%d"):
         response = {'status': StatusCodes['bad_request'],
                     'errors': 'The end date must be after the start date'}
         if conn is not None:
-            conn.close()
-        return flask.jsonify(response)
-
-    verify_dates_statement = 'select exists(select 1 from campaigns where %s <= date_end and %s >= date_start);'
-    verify_dates_values = (payload['date_start'], payload['date_end'])
+            release_connection(conn)
+        return jsonify(response)
 
-    campaign_id_statement = 'select coalesce(max(campaign_id), 0) + 1 from campaigns;'
-
-    campaign_statement = f'insert into campaigns ' \
-                         f'values (%s,%s,%s,%s,%s,%s,%s);'
+    # the campaign id comes from a sequence; overlapping campaigns are rejected by the campaigns_no_overlap constraint
+    campaign_statement = f'insert into campaigns ({", ".join(columns_names["campaigns"][1:])}) ' \
+                         f'values (%s,%s,%s,%s,%s,%s) returning campaign_id;'
 
     try:
-        admin_id = admin_check(" to create a campaign")
+        admin_id = admin_check(" to create a campaign", cur)
 
-        # ensure that the new campaign isn't running at the same time as any other
-        cur.execute(verify_dates_statement, verify_dates_values)
-        if cur.fetchall()[0][0]:
-            raise AlreadyInCampaign
+        campaign_values = tuple([payload[i] for i in columns_names['campaigns'][1:6]] + [admin_id])
 
-        # lock the campaign table to ensure that no errors regarding the campaign id calculation occur in simultaneous campaign creation attempts
-        cur.execute('lock table campaigns;')
+        # insert the new campaign into the campaigns table, unless it would run at the same time as any other
+        try:
+            cur.execute(campaign_statement, campaign_values)
+        except errors.ExclusionViolation:
+            raise AlreadyInCampaign
 
-        # get the id of the new campaign
-        cur.execute(campaign_id_statement)
         campaign_id = cur.fetchone()[0]
 
-        campaign_values = tuple([campaign_id] + list(payload.values()) + [admin_id])
-
-        # insert the new campaign into the campaigns table
-        cur.execute(campaign_statement, campaign_values)
-
         response = {'status': StatusCodes['success'], 'results': f'{campaign_id}'}
         conn.commit()
 
+        # make the new campaign available for subscriptions in this process right away
+        try:
+            campaign_cache.refresh()
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'Campaign cache - error: {error}')
+
     except (AlreadyInCampaign, TokenError, InsufficientPrivilegesException) as error:
         logger.error(f'POST /campaign - error: {error}')
         response = {'status': StatusCodes['bad_request'], 'errors': str(error)}
@@ -1183,9 +3042,32 @@ def add_campaign():
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
+
+    return jsonify(response)
+
 
-    return flask.jsonify(response)
+##
+# List the campaigns that are running and the ones that haven't started yet
+##
+# Served from the in-process campaign cache, so it doesn't require authentication nor touch the database
+##
+# To use it, access through postman:
+##
+# GET http://localhost:8080/dbproj/campaigns
+##
+@bp.route('/dbproj/campaigns', methods=['GET'])
+def get_campaigns():
+    logger.info('GET /dbproj/campaigns')
+
+    try:
+        response = {'status': StatusCodes['success'], 'results': campaign_cache.listing(datetime.now().date())}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /dbproj/campaigns - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return jsonify(response)
 
 
 ##
@@ -1195,38 +3077,38 @@ def add_campaign():
 ##
 # GET http://localhost:8080/dbproj/subscribe/<campaign_id>
 ##
-@app.route('/dbproj/subscribe/<campaign_id>', methods=['PUT'])
+@bp.route('/dbproj/subscribe/<campaign_id>', methods=['PUT'])
 def subscribe_campaign(campaign_id):
     logger.info('PUT /dbproj/subscribe/<campaign_id>')
 
+    time_now = datetime.now()
+
+    # campaigns that don't exist or aren't running are rejected by the campaign cache, without using the database
+    try:
+        if not campaign_cache.is_running(campaign_id, time_now.date()):
+            raise CampaignExpiredOrNotFound
+    except CampaignExpiredOrNotFound as error:
+        logger.error(error)
+        response = {'status': StatusCodes['bad_request'], 'errors': str(error)}
+        return jsonify(response)
+
     conn = db_connection()
     cur = conn.cursor()
 
     # the generated coupon will expire in 30 days
-    time_now = datetime.now()
     expiration_date = time_now + timedelta(days=30)
 
     time_now = time_now.strftime("%Y-%m-%d %H:%M:%S")
     expiration_date = expiration_date.strftime("%Y-%m-%d %H:%M:%S")
 
-    subscribe_statement = 'update campaigns set coupons = coupons - 1 ' \
-                          'where campaign_id = %s and %s between date_start and date_end and coupons > 0;'
-    subscribe_values = (campaign_id, time_now)
-
     user_already_subscribed_statement = 'select exists(select 1 from coupons where buyers_users_user_id = %s and campaigns_campaign_id = %s)'
 
-    gen_coupon_statement = 'select coalesce(max(coupon_id) + 1, 1) from coupons;'
-
-    insert_coupon_statement = f'insert into coupons (coupon_id, used, discount_applied, expiration_date, campaigns_campaign_id, buyers_users_user_id) values (%s,%s,%s,%s,%s,%s);'
+    # claims a coupon from one of the campaign's coupon counters and creates it (see subscribe_coupon)
+    subscribe_statement = 'select subscribe_coupon(%s, %s, %s, %s);'
 
     try:
         # check if the user is a buyer
-        user_id = buyer_check(" to subscribe to coupon campaign")
-
-        # check if the campaign is valid and if it is, decrement by one the coupon count
-        cur.execute(subscribe_statement, subscribe_values)
-        if cur.rowcount == 0:
-            raise CampaignExpiredOrNotFound
+        user_id = buyer_check(" to subscribe to coupon campaign", cur)
 
         # check if the user has already subscribed to this campaign
         user_already_subscribed_values = (user_id, campaign_id)
@@ -1234,16 +3116,17 @@ def subscribe_campaign(campaign_id):
         if cur.fetchall()[0][0]:
             raise UserAlreadySubscribed(campaign_id)
 
-        # lock the coupon table to ensure that no errors regarding the coupon id calculation occur in simultaneous user subscriptions
-        cur.execute('lock table coupons;')
-
-        # get the id of the new coupon
-        cur.execute(gen_coupon_statement)
-        coupon_id = cur.fetchall()[0][0]
+        # check if the campaign is valid and if it is, take one of its coupons
+        subscribe_values = (campaign_id, user_id, time_now, expiration_date)
+        try:
+            cur.execute(subscribe_statement, subscribe_values)
+        except errors.UniqueViolation:
+            # simultaneous subscription of the same user
+            raise UserAlreadySubscribed(campaign_id)
 
-        # insert the new coupon into the coupons table
-        insert_coupon_values = (coupon_id, 'false', 0, expiration_date, campaign_id, user_id)
-        cur.execute(insert_coupon_statement, insert_coupon_values)
+        coupon_id = cur.fetchone()[0]
+        if coupon_id is None:
+            raise CampaignExpiredOrNotFound
 
         response = {'status': StatusCodes['success'],
                     'results': {'coupon_id': coupon_id, 'expiration_date': expiration_date}}
@@ -1262,9 +3145,9 @@ def subscribe_campaign(campaign_id):
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
-    return flask.jsonify(response)
+    return jsonify(response)
 
 
 ##
@@ -1274,7 +3157,7 @@ def subscribe_campaign(campaign_id):
 ##
 # GET http://localhost:8080/dbproj/report/campaign
 ##
-@app.route('/dbproj/report/campaign', methods=['GET'])
+@bp.route('/dbproj/report/campaign', methods=['GET'])
 def get_campaign_stats():
     logger.info('GET /dbproj/report/campaign')
 
@@ -1285,11 +3168,12 @@ def get_campaign_stats():
     stats_statement = "select campaign_id," \
                       "(select count(*) from coupons where campaigns_campaign_id = campaign_id)," \
                       "(select count(*) from coupons where campaigns_campaign_id = campaign_id and used = 'true')," \
+                      "(select count(*) from coupons where campaigns_campaign_id = campaign_id and expired)," \
                       "(select coalesce(sum(discount_applied),0) from coupons where campaigns_campaign_id = campaign_id) " \
                       "from campaigns group by campaign_id"
 
     try:
-        user_check(" to obtain campaign stats")
+        user_check(" to obtain campaign stats", cur)
 
         # get the stats of the campaigns, if at least one exists
         cur.execute(stats_statement)
@@ -1302,7 +3186,8 @@ def get_campaign_stats():
         for row in rows:
             # logger.debug(row)
             content = {'campaign_id': int(row[0]), 'generated_coupons': int(row[1]),
-                       'used_coupons': int(row[2]), 'total_discount_value': float(row[3])}
+                       'used_coupons': int(row[2]), 'expired_coupons': int(row[3]),
+                       'total_discount_value': float(row[4])}
             results.append(content)  # append the stats of each campaign to the results
 
         response = {'status': StatusCodes['success'], 'results': results}
@@ -1320,35 +3205,131 @@ def get_campaign_stats():
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
+
+    return jsonify(response)
+
+
+##
+# Obtain the state of the notification outbox: pending events, lag of the oldest pending event
+# and the batches processed by the worker of this api process
+##
+# To use it, access through postman:
+##
+# GET http://localhost:8080/dbproj/report/outbox
+##
+@bp.route('/dbproj/report/outbox', methods=['GET'])
+def get_outbox_stats():
+    logger.info('GET /dbproj/report/outbox')
+
+    conn = db_connection()
+    conn.set_session(readonly=True)
+    cur = conn.cursor()
+
+    statement = 'select count(*), extract(epoch from (CURRENT_TIMESTAMP - min(created_at))) ' \
+                'from notification_outbox ' \
+                'where processed_at is null;'
+
+    try:
+        admin_check(" to obtain outbox stats", cur)
+
+        cur.execute(statement)
+        row = cur.fetchone()
+
+        results = {'pending_events': row[0], 'lag_seconds': float(row[1]) if row[1] is not None else 0.0,
+                   'worker': outbox_stats}
+
+        response = {'status': StatusCodes['success'], 'results': results}
+        conn.commit()
+
+    except (TokenError, InsufficientPrivilegesException) as error:
+        logger.error(f'GET /dbproj/report/outbox - error: {error}')
+        response = {'status': StatusCodes['bad_request'], 'errors': str(error)}
+        conn.rollback()
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /dbproj/report/outbox - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        conn.rollback()
+
+    finally:
+        if conn is not None:
+            release_connection(conn)
 
-    return flask.jsonify(response)
+    return jsonify(response)
 
 
 ##
-# Get notifications
+# Get notifications, newest first, one page at a time
+##
+# Optional query parameters:
+#   limit  - maximum number of notifications returned (default 50, at most 200)
+#   before - cursor ('next' of a previous page) to get the notifications older than it
+#   since  - cursor ('latest' of a previous page, a notification id) to get only the notifications created after it
+#   unread - if 'true', only the notifications that haven't been marked as read are returned
 ##
 # To use it, access through postman:
 ##
-# GET http://localhost:8080/dbproj/inbox
+# GET http://localhost:8080/dbproj/inbox?limit=20
+# GET http://localhost:8080/dbproj/inbox?before=2022-05-12T10:00:00.000000Z_5
 ##
-@app.route('/dbproj/inbox', methods=['GET'])
+@bp.route('/dbproj/inbox', methods=['GET'])
 def get_notifications():
     logger.info('GET /dbproj/inbox')
 
+    try:
+        limit = int(flask.request.args.get('limit', INBOX_DEFAULT_LIMIT))
+        if not 1 <= limit <= INBOX_MAX_LIMIT:
+            raise ValueError
+        before = parse_inbox_cursor(flask.request.args.get('before'))
+        since = parse_since_cursor(flask.request.args.get('since'))
+    except ValueError:
+        response = {'status': StatusCodes['bad_request'],
+                    'errors': f'limit must be between 1 and {INBOX_MAX_LIMIT} and cursors must be valid'}
+        return jsonify(response)
+
+    unread_only = flask.request.args.get('unread', 'false').lower() == 'true'
+
     conn = db_connection()
+    conn.set_session(readonly=True)
     cur = conn.cursor()
 
     try:
-        user_id = user_check(" to see notification inbox")
+        user_id = user_check(" to see notification inbox", cur)
 
-        statement = 'select notif_time, notification_id, content from notifications where users_user_id = %s'
+        # keyset pagination over the (users_user_id, notif_time, notification_id) index
+        statement = 'select notification_id, notif_time, content, read ' \
+                    'from notifications ' \
+                    'where users_user_id = %s'
         values = [user_id]
 
+        if before is not None:
+            statement += ' and (notif_time, notification_id) < (%s, %s)'
+            values.extend(before)
+        if since is not None:
+            statement += ' and notification_id > %s'
+            values.append(since)
+        if unread_only:
+            statement += ' and not read'
+
+        # when polling for new notifications the oldest ones are returned first, so that no notification is skipped
+        # when there are more than <limit> new ones; the page is always returned newest first
+        if since is not None and before is None:
+            statement += ' order by notification_id limit %s;'
+        else:
+            statement += ' order by notif_time desc, notification_id desc limit %s;'
+        values.append(limit)
+
         cur.execute(statement, values)
-        notifications = cur.fetchall()
+        rows = cur.fetchall()
+        if since is not None and before is None:
+            rows.reverse()
 
-        response = {'status': StatusCodes['success'], 'results': notifications}
+        notifications = [{'notification_id': r[0], 'notif_time': r[1], 'content': r[2], 'read': r[3]} for r in rows]
+
+        response = {'status': StatusCodes['success'], 'results': notifications,
+                    'next': inbox_cursor(rows[-1]) if len(rows) == limit else None,
+                    'latest': str(max(r[0] for r in rows)) if rows else flask.request.args.get('since')}
         conn.commit()
 
     except (TokenError, InsufficientPrivilegesException) as error:
@@ -1363,26 +3344,213 @@ def get_notifications():
 
     finally:
         if conn is not None:
-            conn.close()
+            release_connection(conn)
 
-    return flask.jsonify(response)
+    return jsonify(response)
 
 
-if __name__ == '__main__':
-    # set up logging
-    logging.basicConfig(filename='log_file.log')
-    logger = logging.getLogger('logger')
-    logger.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
+##
+# Mark notifications as read with a JSON payload
+##
+# The payload lists the notification ids to mark ({"read": [1, 2, 3]}) or marks the whole inbox ({"read": "all"})
+##
+# To use it, access through postman:
+##
+# PUT http://localhost:8080/dbproj/inbox
+##
+@bp.route('/dbproj/inbox', methods=['PUT'])
+def read_notifications():
+    logger.info('PUT /dbproj/inbox')
+    payload = flask.request.get_json()
 
-    # create formatter
-    formatter = logging.Formatter('%(asctime)s [%(levelname)s]:  %(message)s', '%H:%M:%S')
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    if 'read' not in payload or (payload['read'] != 'all' and not isinstance(payload['read'], list)):
+        response = {'status': StatusCodes['bad_request'],
+                    'errors': 'read must be a list of notification ids or \'all\''}
+        return jsonify(response)
+
+    conn = db_connection()
+    cur = conn.cursor()
+
+    statement = 'update notifications set read = true where users_user_id = %s and not read'
+
+    try:
+        user_id = user_check(" to manage the notification inbox", cur)
+
+        values = [user_id]
+        if payload['read'] != 'all':
+            statement += ' and notification_id = any(%s)'
+            values.append(payload['read'])
+
+        cur.execute(statement, values)
 
+        response = {'status': StatusCodes['success'], 'results': cur.rowcount}
+        conn.commit()
+
+    except (TokenError, InsufficientPrivilegesException) as error:
+        logger.error(f'PUT /dbproj/inbox - error: {error}')
+        response = {'status': StatusCodes['bad_request'], 'errors': str(error)}
+        conn.rollback()
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'PUT /dbproj/inbox - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        conn.rollback()
+
+    finally:
+        if conn is not None:
+            release_connection(conn)
+
+    return jsonify(response)
+
+
+##
+# Receive new notifications as they arrive, as Server-Sent Events
+##
+# Each notification is sent as a 'notification' event whose id is its inbox cursor; when reconnecting,
+# the notifications missed since the Last-Event-ID header (or the 'since' query parameter) are sent first
+##
+# To use it, access through postman:
+##
+# GET http://localhost:8080/dbproj/inbox/stream
+##
+@bp.route('/dbproj/inbox/stream', methods=['GET'])
+def stream_notifications():
+    logger.info('GET /dbproj/inbox/stream')
+
+    try:
+        since = flask.request.headers.get('Last-Event-ID', flask.request.args.get('since'))
+        since_values = parse_since_cursor(since)
+    except ValueError:
+        response = {'status': StatusCodes['bad_request'], 'errors': 'Invalid cursor'}
+        return jsonify(response)
+
+    try:
+        user_id = user_check(" to receive notifications")
+
+    except (TokenError, InsufficientPrivilegesException) as error:
+        logger.error(f'GET /dbproj/inbox/stream - error: {error}')
+        response = {'status': StatusCodes['bad_request'], 'errors': str(error)}
+        return jsonify(response)
+
+    # subscribe before reading the missed notifications, so that none is lost in between
+    # (a notification may be sent twice, clients should ignore repeated event ids)
+    notif_queue = inbox_listener.subscribe(user_id)
+    if notif_queue is None:
+        logger.warning('GET /dbproj/inbox/stream - too many open streams')
+        response = {'status': StatusCodes['service_unavailable'],
+                    'errors': 'Too many open notification streams, use GET /dbproj/inbox or try again later'}
+        return jsonify(response)
+
+    def event(notification):
+        return f'id: {notification["cursor"]}\nevent: notification\ndata: {json.dumps(notification)}\n\n'
+
+    def generate():
+        yield ': connected\n\n'
+
+        if since_values is not None:
+            for notification in missed_notifications(user_id, since_values):
+                yield event(notification)
+        else:
+            # an event with only an id sets the Last-Event-ID the client sends when it reconnects, so that even a
+            # client that got no notification yet gets the ones it misses (see InboxListener.close_stream)
+            yield f'id: {latest_notification_id(user_id)}\n\n'
+
+        while True:
+            try:
+                notification = notif_queue.get(timeout=INBOX_STREAM_KEEPALIVE)
+                if notification is None:
+                    # closed by the listener (see close_stream)
+                    return
+                yield event(notification)
+            except queue.Empty:
+                # comments keep idle connections (and proxies) from timing out
+                yield ': keepalive\n\n'
+
+    response = flask.Response(streamed(generate()), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # when the response is closed, even if the generator never started, the stream is given back
+    response.call_on_close(lambda: inbox_listener.unsubscribe(user_id, notif_queue))
+    return response
+
+
+##
+# Obtain the metrics of the api, in the Prometheus text format: requests by endpoint and status, latency histograms,
+# time spent executing statements, statements executed and time waiting for a pooled connection
+##
+# It doesn't require authentication, so that it can be scraped; it should only be reachable from the monitoring
+##
+# To use it, access through postman:
+##
+# GET http://localhost:8080/metrics
+##
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    try:
+        body = render_metrics(collect_metrics())
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /metrics - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        return jsonify(response)
+
+    return flask.Response(body, mimetype='text/plain; version=0.0.4')
+
+
+##########################################################
+# APPLICATION
+##########################################################
+
+# Makes the application; <overrides> replaces the settings from the environment. No connection is opened here,
+# so the application can be loaded by a process that then forks the workers
+def create_app(overrides=None):
+    settings.update(load_config(overrides))
+    setup_logging()
+
+    app = flask.Flask(__name__)
+    app.config['SECRET_KEY'] = settings['SECRET_KEY']
+    app.config['SESSION_COOKIE_NAME'] = settings['SESSION_COOKIE_NAME']
+    app.register_blueprint(bp)
+
+    return app
+
+
+background_workers = [outbox_worker, campaign_cache_worker, coupon_sweeper, refresh_token_purger, metrics_writer,
+                      trace_exporter]
+
+
+# Starts the background jobs of this process, once per worker process (see gunicorn.conf.py). Every worker runs
+# them: the outbox, the coupon sweeper and the refresh token purge skip the rows locked by the other workers
+def init_worker():
+    start_log_listeners()
+
+    # notifications are created off the request path by the outbox worker
+    for worker in background_workers:
+        if not worker.is_alive():
+            worker.start()
+
+
+def shutdown_worker():
+    for worker in background_workers:
+        worker.stop()
+    inbox_listener.stop()
+
+    # the counters of a worker that exits are still added up by GET /metrics
+    write_metrics()
+    export_spans()
+    stop_log_listeners()
+
+    with pool_lock:
+        if pool is not None:
+            pool.close()
+
+
+if __name__ == '__main__':
     host = '127.0.0.1'
     port = 8080
 
+    # development server; in production the api is served by gunicorn (see wsgi.py)
+    app = create_app()
+    init_worker()
+
     app.run(host=host, debug=True, threaded=True, port=port)
     logger.info(f'API online: http://{host}:{port}')
@@ -0,0 +1,475 @@
+"""
+Synthetic data for scale testing
+
+Fills an empty dbproj database (or, with --truncate, empties it first) with a consistent dataset of the given
+size: admins, sellers and buyers, products with several versions (smartphones, televisions and computers),
+orders with their products, sellers and ratings, question threads, campaigns with their coupon counters and
+coupons (some of them used by orders or already expired). Every row is a function of its ids and of --seed, so
+the same arguments always make the same data, and the tables are loaded with COPY in a single transaction.
+
+The triggers and the foreign key checks are turned off during the load (session_replication_role = replica, which
+requires a superuser): the rows are made consistent with every foreign key of dbproj_create_tables.sql, and --check
+verifies it afterwards. The notifications of the rows loaded aren't created. Every user has the password given by
+--password, so the buyers ('user_<id>') can be used by benchmarks/load_test.py:
+
+    python benchmarks/generate_data.py --dsn "dbname=dbproj user=postgres host=127.0.0.1" --truncate \
+        --users 2000000 --products 200000 --orders 3000000 --questions 1000000 --campaigns 100
+"""
+
+import argparse
+import time
+from datetime import date, datetime, timedelta
+import psycopg2
+from psycopg2 import sql
+
+# tags that make the values drawn for different purposes from the same ids independent
+VERSIONS, PRICE, STOCK, SELLER, BUYER, DAY, ITEMS, ITEM, RATED, RATING, QUESTIONS, QUESTION_USER, REPLY, \
+    PARENT, SUBSCRIBED, USED, ORDERED, DISCOUNT, ADMIN, FIRST_BUYER, SECOND = range(21)
+
+OS = ['Android', 'iOS']
+STORAGE = ['64 GB', '128 GB', '256 GB', '512 GB', '1 TB']
+COLORS = ['Preto', 'Branco', 'Azul', 'Verde', 'Vermelho']
+SCREEN_TYPES = ['LCD-LED', 'OLED', 'QLED']
+RESOLUTIONS = ['Full HD', '4K Ultra HD', '8K']
+EFFICIENCY = ['A', 'B', 'C', 'D', 'E', 'F', 'G']
+CPUS = ['Intel Core i5-12400', 'Intel Core i7-12700H', 'AMD Ryzen 5 5600H', 'AMD Ryzen 7 5800X']
+GPUS = ['NVIDIA GeForce RTX 3060', 'NVIDIA GeForce RTX 3080', 'AMD Radeon RX 6700', 'Intel Iris Xe']
+COMMENTS = ['muito bom', 'recomendo', 'chegou rapido', 'razoavel', 'nao gostei', 'excelente relacao qualidade/preco']
+QUESTIONS_TEXT = ['Tem garantia?', 'Qual a autonomia da bateria?', 'Tem stock na loja?', 'Inclui carregador?',
+                  'Sim, tem.', 'Obrigado pela resposta.']
+
+# tables in the order they are loaded and their columns
+TABLES = [
+    ('users', ['user_id', 'username', 'password', 'email']),
+    ('admins', ['users_user_id']),
+    ('sellers', ['users_user_id', 'nif', 'shipping_addr']),
+    ('buyers', ['users_user_id', 'nif', 'home_addr']),
+    ('products', ['product_id', 'version', 'name', 'price', 'stock', 'description', 'sellers_users_user_id']),
+    ('smartphones', ['screen_size', 'os', 'storage', 'color', 'products_product_id', 'products_version']),
+    ('televisions', ['screen_size', 'screen_type', 'resolution', 'smart', 'efficiency', 'products_product_id',
+                     'products_version']),
+    ('computers', ['screen_size', 'cpu', 'gpu', 'storage', 'refresh_rate', 'products_product_id',
+                   'products_version']),
+    ('campaigns', ['campaign_id', 'description', 'date_start', 'date_end', 'coupons', 'discount',
+                   'admins_users_user_id']),
+    ('campaign_coupon_shards', ['campaigns_campaign_id', 'shard', 'remaining']),
+    ('coupons', ['coupon_id', 'used', 'discount_applied', 'expiration_date', 'campaigns_campaign_id',
+                 'buyers_users_user_id', 'orders_id', 'expired']),
+    ('orders', ['id', 'order_date', 'price_total', 'coupons_coupon_id', 'coupons_campaigns_campaign_id',
+                'buyers_users_user_id']),
+    ('product_quantities', ['quantity', 'orders_id', 'products_product_id', 'products_version']),
+    ('sellers_orders', ['sellers_users_user_id', 'orders_id']),
+    ('ratings', ['comment', 'rating', 'orders_id', 'products_product_id', 'products_version',
+                 'buyers_users_user_id']),
+    ('questions', ['question_id', 'question_text', 'users_user_id', 'products_product_id', 'products_version',
+                   'questions_question_id', 'questions_users_user_id']),
+    ('product_question_counters', ['products_product_id', 'last_question_id'])
+]
+
+# all the tables of the schema, emptied by --truncate
+ALL_TABLES = [table for table, _ in TABLES] + ['refresh_tokens', 'notifications', 'notifications_archive',
+                                                'notification_outbox']
+
+SEQUENCES = [('users_user_id_seq', 'users', 'user_id'), ('coupons_coupon_id_seq', 'coupons', 'coupon_id'),
+             ('campaigns_campaign_id_seq', 'campaigns', 'campaign_id')]
+
+
+# COPY reads the rows through this file-like object, a chunk of lines at a time, as they are made
+class RowStream:
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.count = 0
+
+    def read(self, size=-1):
+        lines = []
+        length = 0
+        for row in self.rows:
+            line = '\t'.join('\\N' if value is None else str(value) for value in row) + '\n'
+            lines.append(line)
+            length += len(line)
+            if length >= size > 0:
+                break
+
+        self.count += len(lines)
+        return ''.join(lines)
+
+
+class Dataset:
+    def __init__(self, args, password_hash):
+        self.seed = args.seed
+        self.password_hash = password_hash
+        self.admins = args.admins
+        self.sellers = args.sellers
+        self.users = args.users
+        self.first_seller = args.admins + 1
+        self.first_buyer = args.admins + args.sellers + 1
+        self.buyers = args.users - args.admins - args.sellers
+        self.products = args.products
+        self.max_versions = args.max_versions
+        self.orders = args.orders
+        self.rating_percent = args.rating_percent
+        self.questions_per_product = args.questions / args.products
+        self.reply_percent = args.reply_percent
+        self.campaigns = args.campaigns
+        self.coupons_per_campaign = min(args.coupons_per_campaign, self.buyers)
+        self.used_percent = args.used_percent
+
+        self.today = date.today()
+        self.days = args.days
+        # the campaigns don't overlap and fit in the last <days> days, like the orders: two weeks each, or shorter
+        # when there are too many of them
+        self.campaign_period = min(15, (args.days + 1) // args.campaigns) if args.campaigns > 0 else 15
+        # every version of the products exists before the first order
+        self.first_day = self.today - timedelta(days=args.days)
+        self.first_version = datetime.combine(self.first_day, datetime.min.time())
+
+    def h(self, *values):
+        # the hash of a tuple of ints is the same in every run (unlike the hash of a str)
+        return hash((self.seed,) + values) & 0x7fffffff
+
+    # USERS
+
+    def user_rows(self):
+        for user_id in range(1, self.users + 1):
+            yield user_id, f'user_{user_id}', self.password_hash, f'user_{user_id}@dbproj.pt'
+
+    def admin_rows(self):
+        for user_id in range(1, self.admins + 1):
+            yield user_id,
+
+    def seller_rows(self):
+        for user_id in range(self.first_seller, self.first_buyer):
+            yield user_id, 500000000 + user_id % 100000000, f'Armazem {user_id}'
+
+    def buyer_rows(self):
+        for user_id in range(self.first_buyer, self.users + 1):
+            yield user_id, 200000000 + user_id % 100000000, f'Rua {user_id}'
+
+    # PRODUCTS
+
+    def versions(self, product_id):
+        return 1 + self.h(VERSIONS, product_id) % self.max_versions
+
+    # the versions are a week apart, the last one a week before the first order
+    def version_time(self, product_id, version):
+        seconds = self.h(SECOND, product_id) % 86400
+        when = self.first_version - timedelta(days=7 * (self.versions(product_id) - version), seconds=seconds)
+        return when.strftime('%Y-%m-%d %H:%M:%S')
+
+    def last_version(self, product_id):
+        return self.version_time(product_id, self.versions(product_id) - 1)
+
+    def price(self, product_id, version):
+        return round(50 + self.h(PRICE, product_id) % 2000 + 10 * version + 0.99, 2)
+
+    def seller(self, product_id):
+        return self.first_seller + self.h(SELLER, product_id) % self.sellers
+
+    def product_type(self, product_id):
+        return ('smartphones', 'televisions', 'computers')[product_id % 3]
+
+    def product_rows(self):
+        for product_id in range(1, self.products + 1):
+            kind = self.product_type(product_id)
+            for version in range(self.versions(product_id)):
+                yield product_id, self.version_time(product_id, version), f'{kind[:-1]} {product_id}', \
+                    self.price(product_id, version), 1000 + self.h(STOCK, product_id) % 9000, \
+                    f'{kind[:-1]} {product_id}, versao {version + 1}', self.seller(product_id)
+
+    def type_rows(self, kind):
+        for product_id in range(1, self.products + 1):
+            if self.product_type(product_id) != kind:
+                continue
+
+            h = self.h(VERSIONS, product_id)
+            for version in range(self.versions(product_id)):
+                version_time = self.version_time(product_id, version)
+                if kind == 'smartphones':
+                    yield 5.5 + h % 15 / 10, OS[h % 2], STORAGE[(h + version) % 4], COLORS[h % 5], product_id, \
+                        version_time
+                elif kind == 'televisions':
+                    yield 32 + h % 5 * 11, SCREEN_TYPES[h % 3], RESOLUTIONS[h % 3], h % 4 != 0, EFFICIENCY[h % 7], \
+                        product_id, version_time
+                else:
+                    yield 13.3 + h % 4 * 1.1, CPUS[(h + version) % 4], GPUS[h % 4], STORAGE[1 + h % 4], \
+                        60 + h % 3 * 60, product_id, version_time
+
+    # ORDERS
+
+    # the products (their last version, one of each) of an order; the same for the orders of the coupons
+    def order_items(self, order_id):
+        items = {}
+        for i in range(1 + self.h(ITEMS, order_id) % 3):
+            product_id = 1 + self.h(ITEM, order_id, i) % self.products
+            items[product_id] = self.last_version(product_id)
+        return items
+
+    def order_total(self, items):
+        return round(sum(self.price(product_id, self.versions(product_id) - 1) for product_id in items), 2)
+
+    # orders 1..<orders> are placed without coupons, the next ones with the coupons used (see coupon_list)
+    def order_list(self):
+        for order_id in range(1, self.orders + 1):
+            items = self.order_items(order_id)
+            buyer = self.first_buyer + self.h(BUYER, order_id) % self.buyers
+            order_date = self.first_day + timedelta(days=self.h(DAY, order_id) % (self.days + 1))
+            yield order_id, order_date, self.order_total(items), None, None, buyer, items
+
+        for coupon in self.coupon_list():
+            if coupon['order_id'] is not None:
+                items = self.order_items(coupon['order_id'])
+                yield coupon['order_id'], coupon['order_date'], coupon['order_total'], coupon['coupon_id'], \
+                    coupon['campaign_id'], coupon['buyer'], items
+
+    def order_rows(self):
+        for order in self.order_list():
+            yield order[:6]
+
+    def product_quantity_rows(self):
+        for order in self.order_list():
+            for product_id, version in order[6].items():
+                yield 1, order[0], product_id, version
+
+    def seller_order_rows(self):
+        for order in self.order_list():
+            for seller in sorted({self.seller(product_id) for product_id in order[6]}):
+                yield seller, order[0]
+
+    def rating_rows(self):
+        for order in self.order_list():
+            for product_id, version in order[6].items():
+                if self.h(RATED, order[0], product_id) % 100 < self.rating_percent:
+                    h = self.h(RATING, order[0], product_id)
+                    yield COMMENTS[h % len(COMMENTS)], 1 + h % 5, order[0], product_id, version, order[5]
+
+    # QUESTIONS
+
+    def question_count(self, product_id):
+        return self.h(QUESTIONS, product_id) % (int(round(2 * self.questions_per_product)) + 1)
+
+    def question_user(self, product_id, question_id):
+        return 1 + self.h(QUESTION_USER, product_id, question_id) % self.users
+
+    # questions are numbered 1..n in each product, as next_question_id does; some of them reply to earlier ones
+    def question_rows(self):
+        for product_id in range(1, self.products + 1):
+            version = None
+            for question_id in range(1, self.question_count(product_id) + 1):
+                version = version or self.last_version(product_id)
+
+                parent = None
+                if question_id > 1 and self.h(REPLY, product_id, question_id) % 100 < self.reply_percent:
+                    parent = 1 + self.h(PARENT, product_id, question_id) % (question_id - 1)
+
+                yield question_id, QUESTIONS_TEXT[question_id % len(QUESTIONS_TEXT)], \
+                    self.question_user(product_id, question_id), product_id, version, parent, \
+                    self.question_user(product_id, parent) if parent is not None else None
+
+    def question_counter_rows(self):
+        for product_id in range(1, self.products + 1):
+            count = self.question_count(product_id)
+            if count > 0:
+                yield product_id, count
+
+    # CAMPAIGNS AND COUPONS
+
+    # one after the other, the last one is running; the first one starts after first_day, so that the orders of
+    # their coupons are in the last <days> days too (and after every product version)
+    def campaign_dates(self, campaign_id):
+        period = self.campaign_period
+        date_start = self.today - timedelta(days=(period - 1) // 2 + period * (self.campaigns - campaign_id))
+        return date_start, date_start + timedelta(days=period - 1)
+
+    def campaign_discount(self, campaign_id):
+        return 5 + self.h(DISCOUNT, campaign_id) % 46
+
+    def campaign_rows(self):
+        for campaign_id in range(1, self.campaigns + 1):
+            date_start, date_end = self.campaign_dates(campaign_id)
+            # half of the coupons of each campaign are already subscribed
+            yield campaign_id, f'campanha {campaign_id}', date_start, date_end, 2 * self.coupons_per_campaign, \
+                self.campaign_discount(campaign_id), 1 + self.h(ADMIN, campaign_id) % self.admins
+
+    # the counters of the coupons left, as made by campaign_shards
+    def shard_rows(self):
+        for campaign_id in range(1, self.campaigns + 1):
+            coupons = 2 * self.coupons_per_campaign
+            remaining = coupons - self.coupons_per_campaign
+            shards = max(min(coupons, 16), 1)
+            for shard in range(shards):
+                yield campaign_id, shard, remaining // shards + (1 if shard < remaining % shards else 0)
+
+    def coupon_list(self):
+        coupon_id = 0
+        order_id = self.orders
+        for campaign_id in range(1, self.campaigns + 1):
+            date_start, date_end = self.campaign_dates(campaign_id)
+            last_subscription = min(date_end, self.today)
+            first_buyer = self.h(FIRST_BUYER, campaign_id)
+
+            for i in range(self.coupons_per_campaign):
+                coupon_id += 1
+                # consecutive buyers, so that no buyer subscribes twice to the same campaign
+                buyer = self.first_buyer + (first_buyer + i) % self.buyers
+                subscribed = date_start + timedelta(
+                    days=self.h(SUBSCRIBED, coupon_id) % ((last_subscription - date_start).days + 1))
+                expiration = subscribed + timedelta(days=30)
+
+                coupon = {'coupon_id': coupon_id, 'campaign_id': campaign_id, 'buyer': buyer,
+                          'expiration': expiration, 'order_id': None, 'order_date': None, 'order_total': None,
+                          'discount_applied': 0}
+
+                # a coupon is used before it expires, and not after today
+                if self.h(USED, coupon_id) % 100 < self.used_percent:
+                    order_id += 1
+                    last_order_day = min(expiration - timedelta(days=1), self.today)
+                    total = self.order_total(self.order_items(order_id))
+                    discount = round(total * self.campaign_discount(campaign_id) / 100, 2)
+                    coupon.update({'order_id': order_id, 'order_total': round(total - discount, 2),
+                                   'discount_applied': discount,
+                                   'order_date': subscribed + timedelta(
+                                       days=self.h(ORDERED, coupon_id) % ((last_order_day - subscribed).days + 1))})
+
+                yield coupon
+
+    def coupon_rows(self):
+        for coupon in self.coupon_list():
+            used = coupon['order_id'] is not None
+            yield coupon['coupon_id'], used, coupon['discount_applied'], coupon['expiration'], \
+                coupon['campaign_id'], coupon['buyer'], coupon['order_id'], \
+                not used and coupon['expiration'] < self.today
+
+    def rows(self, table):
+        if table in ('smartphones', 'televisions', 'computers'):
+            return self.type_rows(table)
+
+        return {'users': self.user_rows, 'admins': self.admin_rows, 'sellers': self.seller_rows,
+                'buyers': self.buyer_rows, 'products': self.product_rows, 'campaigns': self.campaign_rows,
+                'campaign_coupon_shards': self.shard_rows, 'coupons': self.coupon_rows, 'orders': self.order_rows,
+                'product_quantities': self.product_quantity_rows, 'sellers_orders': self.seller_order_rows,
+                'ratings': self.rating_rows, 'questions': self.question_rows,
+                'product_question_counters': self.question_counter_rows}[table]()
+
+
+def load(cur, dataset, freeze):
+    for table, columns in TABLES:
+        start = time.perf_counter()
+        stream = RowStream(dataset.rows(table))
+
+        statement = sql.SQL('copy {} ({}) from stdin {}').format(
+            sql.Identifier(table), sql.SQL(', ').join(map(sql.Identifier, columns)),
+            sql.SQL('with (freeze)' if freeze else ''))
+        cur.copy_expert(statement, stream, size=1 << 16)
+
+        elapsed = time.perf_counter() - start
+        print(f'{table}: {stream.count} rows in {elapsed:.1f}s ({stream.count / max(elapsed, 1e-9):.0f} rows/s)')
+
+
+# Counts, for each foreign key of the schema, the rows whose (non null) key has no referenced row
+def check_foreign_keys(cur):
+    cur.execute('select conname, conrelid::regclass::text, confrelid::regclass::text, '
+                'array(select attname from unnest(conkey) with ordinality as k(attnum, n) '
+                'join pg_attribute on attrelid = conrelid and attnum = k.attnum order by n), '
+                'array(select attname from unnest(confkey) with ordinality as k(attnum, n) '
+                'join pg_attribute on attrelid = confrelid and attnum = k.attnum order by n) '
+                'from pg_constraint '
+                "where contype = 'f' and connamespace = 'public'::regnamespace "
+                'order by conrelid::regclass::text, conname;')
+
+    violations = 0
+    for name, table, referenced, columns, referenced_columns in cur.fetchall():
+        statement = sql.SQL('select count(*) from {} as c '
+                            'where {} and not exists (select 1 from {} as p where {})').format(
+            sql.Identifier(table),
+            sql.SQL(' and ').join(sql.SQL('c.{} is not null').format(sql.Identifier(c)) for c in columns),
+            sql.Identifier(referenced),
+            sql.SQL(' and ').join(sql.SQL('p.{} = c.{}').format(sql.Identifier(p), sql.Identifier(c))
+                                  for p, c in zip(referenced_columns, columns)))
+        cur.execute(statement)
+        missing = cur.fetchone()[0]
+        violations += missing
+        if missing > 0:
+            print(f'  {name}: {missing} rows of {table} without the referenced row of {referenced}')
+
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load a consistent synthetic dataset of the given size with COPY')
+    parser.add_argument('--dsn', default='dbname=dbproj user=postgres host=127.0.0.1')
+    parser.add_argument('--users', type=int, default=100000, help='admins, sellers and buyers')
+    parser.add_argument('--admins', type=int, default=10)
+    parser.add_argument('--sellers', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--max-versions', type=int, default=5, help='versions of each product, from 1 to this')
+    parser.add_argument('--orders', type=int, default=200000, help='orders without coupons')
+    parser.add_argument('--days', type=int, default=365,
+                        help='the orders and the campaigns are in the last <days> days')
+    parser.add_argument('--rating-percent', type=int, default=30, help='percentage of the products ordered rated')
+    parser.add_argument('--questions', type=int, default=100000, help='about this many questions and replies')
+    parser.add_argument('--reply-percent', type=int, default=50, help='percentage of the questions that are replies')
+    parser.add_argument('--campaigns', type=int, default=50)
+    parser.add_argument('--coupons-per-campaign', type=int, default=1000, help='coupons subscribed per campaign')
+    parser.add_argument('--used-percent', type=int, default=40, help='percentage of the coupons used by an order')
+    parser.add_argument('--password', default='password', help='password of every user')
+    parser.add_argument('--seed', type=int, default=2022)
+    parser.add_argument('--truncate', action='store_true', help='empty every table of the schema first')
+    parser.add_argument('--check', action='store_true', help='verify the foreign keys after loading')
+    args = parser.parse_args()
+
+    if args.users <= args.admins + args.sellers or args.admins < 1 or args.sellers < 1 or args.products < 1:
+        parser.error('at least one admin, one seller, one buyer and one product are required')
+    if args.campaigns > args.days + 1:
+        parser.error('the campaigns don\'t overlap, so there can be at most one per day of --days')
+
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+    start = time.perf_counter()
+
+    try:
+        # the triggers (notifications, coupon counters) and the foreign key checks are skipped
+        cur.execute('set session_replication_role = replica;')
+
+        if args.truncate:
+            cur.execute(sql.SQL('truncate table {} restart identity cascade;').format(
+                sql.SQL(', ').join(map(sql.Identifier, ALL_TABLES))))
+        else:
+            cur.execute('select exists (select 1 from users) or exists (select 1 from products);')
+            if cur.fetchone()[0]:
+                raise SystemExit('the database already has users or products, use --truncate to empty it')
+
+        # every user has the same password hash, computed once
+        cur.execute("select crypt(%s, gen_salt('bf'));", (args.password,))
+        dataset = Dataset(args, cur.fetchone()[0])
+
+        # rows copied into tables truncated in the same transaction can be frozen, so they aren't rewritten
+        # by the first vacuum
+        load(cur, dataset, freeze=args.truncate)
+
+        for sequence, table, column in SEQUENCES:
+            cur.execute(sql.SQL('select setval({}, coalesce((select max({}) from {}), 0) + 1, false);').format(
+                sql.Literal(sequence), sql.Identifier(column), sql.Identifier(table)))
+
+        cur.execute('set session_replication_role = default;')
+        conn.commit()
+
+    except (Exception, psycopg2.DatabaseError):
+        conn.rollback()
+        conn.close()
+        raise
+
+    print(f'loaded in {time.perf_counter() - start:.1f}s')
+
+    # statistics for the planner, as the data is now very different
+    conn.autocommit = True
+    cur.execute('analyze;')
+
+    if args.check:
+        violations = check_foreign_keys(cur)
+        print(f'foreign keys checked: {violations} rows without the referenced row')
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""
+Load test of the api with a marketplace workload
+
+Registers and logs in one buyer per client, then runs <clients> concurrent clients for <duration> seconds against
+a running api. Each client repeatedly picks an operation from the mix, with the given weights:
+
+    browse     GET  /dbproj/product/<product_id>
+    threads    GET  /dbproj/questions/<product_id>
+    campaigns  GET  /dbproj/campaigns
+    login      PUT  /dbproj/user
+    checkout   POST /dbproj/order (1 to 3 products)
+    rating     POST /dbproj/rating/<product_id> (of a product the client bought, otherwise a checkout)
+    question   POST /dbproj/questions/<product_id>
+    subscribe  PUT  /dbproj/subscribe/<campaign_id> (of a running campaign, once per client and campaign)
+
+and reports the throughput and the latency percentiles of each operation. An operation fails when the status in
+the response isn't 200; the ones refused by the login throttle (429) are counted apart, as all the clients share
+the same address. The users, orders, ratings and questions created are not deleted (the usernames start with
+'load_<run id>_'), so run it against a test database:
+
+    python benchmarks/load_test.py --url http://127.0.0.1:8080 --clients 16 --duration 60 --products 1-100000 \
+        --mix browse=50,threads=10,campaigns=5,login=2,checkout=15,rating=5,question=8,subscribe=5
+"""
+
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+DEFAULT_MIX = 'browse=50,threads=10,campaigns=5,login=2,checkout=15,rating=5,question=8,subscribe=5'
+PASSWORD = 'load-password'
+
+# tokens are valid for 20 minutes
+TOKEN_RENEWAL = 15 * 60
+
+
+def call(url, method, path, payload=None, token=None):
+    headers = {'Content-Type': 'application/json'}
+    if token is not None:
+        headers['Authorization'] = f'Bearer {token}'
+    data = json.dumps(payload).encode() if payload is not None else None
+    request = urllib.request.Request(f'{url}{path}', data=data, method=method, headers=headers)
+
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            body = json.loads(response.read())
+        status = body.get('status', response.status)
+    except urllib.error.HTTPError as error:
+        body = {}
+        status = error.code
+    except (urllib.error.URLError, ValueError):
+        body = {}
+        status = 0
+
+    return time.perf_counter() - start, status, body
+
+
+def parse_ids(text):
+    ids = []
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        ids.extend(range(int(first), int(last or first) + 1))
+    return ids
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+class Client:
+    def __init__(self, url, username, products, campaigns):
+        self.url = url
+        self.username = username
+        self.products = products
+        self.campaigns = campaigns
+        self.token = None
+        self.logged_in_at = 0.0
+        self.bought = []
+        self.subscribed = set()
+
+    def login(self):
+        latency, status, body = call(self.url, 'PUT', '/dbproj/user',
+                                     {'username': self.username, 'password': PASSWORD})
+        if status == 200:
+            self.token = body['token']
+            self.logged_in_at = time.monotonic()
+        return latency, status
+
+    def browse(self):
+        return call(self.url, 'GET', f'/dbproj/product/{random.choice(self.products)}')[:2]
+
+    def threads(self):
+        return call(self.url, 'GET', f'/dbproj/questions/{random.choice(self.products)}?limit=10')[:2]
+
+    def list_campaigns(self):
+        return call(self.url, 'GET', '/dbproj/campaigns')[:2]
+
+    def checkout(self):
+        cart = [{'product_id': product_id, 'quantity': 1}
+                for product_id in random.sample(self.products, min(len(self.products), random.randint(1, 3)))]
+        latency, status, _ = call(self.url, 'POST', '/dbproj/order', {'cart': cart}, self.token)
+        if status == 200:
+            self.bought.extend(item['product_id'] for item in cart)
+        return latency, status
+
+    def rating(self):
+        return call(self.url, 'POST', f'/dbproj/rating/{random.choice(self.bought)}',
+                    {'comment': 'load test rating', 'rating': random.randint(1, 5)}, self.token)[:2]
+
+    def question(self):
+        return call(self.url, 'POST', f'/dbproj/questions/{random.choice(self.products)}',
+                    {'question': 'load test question'}, self.token)[:2]
+
+    def subscribe(self):
+        campaign_id = random.choice(self.campaigns)
+        latency, status, _ = call(self.url, 'PUT', f'/dbproj/subscribe/{campaign_id}', token=self.token)
+        self.subscribed.add(campaign_id)
+        return latency, status
+
+    # returns the name of the operation run, its latency and its status
+    def run(self, operation):
+        if time.monotonic() - self.logged_in_at > TOKEN_RENEWAL:
+            self.login()
+
+        if operation == 'rating' and not self.bought:
+            operation = 'checkout'
+        if operation == 'subscribe' and self.subscribed.issuperset(self.campaigns):
+            operation = 'browse'
+
+        function = {'browse': self.browse, 'threads': self.threads, 'campaigns': self.list_campaigns,
+                    'login': self.login, 'checkout': self.checkout, 'rating': self.rating,
+                    'question': self.question, 'subscribe': self.subscribe}[operation]
+        return (operation,) + function()
+
+
+def setup(url, run_id, clients, products):
+    _, _, body = call(url, 'GET', '/dbproj/campaigns')
+    campaigns = [c['campaign_id'] for c in body.get('results', {}).get('active', [])]
+
+    users = []
+    for i in range(clients):
+        username = f'load_{run_id}_{i}'
+        _, status, body = call(url, 'POST', '/dbproj/user/',
+                               {'username': username, 'password': PASSWORD, 'email': f'{username}@load.pt',
+                                'type': 'buyers', 'nif': 123456789, 'home_addr': 'load test'})
+        if status != 200:
+            raise SystemExit(f'could not register {username}: {body}')
+
+        client = Client(url, username, products, campaigns)
+        # the login throttle allows a few logins per second from the same address
+        while client.login()[1] == 429:
+            time.sleep(1)
+        users.append(client)
+
+    return users, campaigns
+
+
+def run(users, mix, duration, warmup):
+    operations = list(mix)
+    weights = [mix[operation] for operation in operations]
+
+    lock = threading.Lock()
+    results = {}
+    start = time.monotonic()
+    measure_from = start + warmup
+    stop_at = measure_from + duration
+
+    def worker(client):
+        while True:
+            now = time.monotonic()
+            if now >= stop_at:
+                return
+
+            operation, latency, status = client.run(random.choices(operations, weights)[0])
+            if now < measure_from:
+                continue
+
+            with lock:
+                result = results.setdefault(operation, {'latencies': [], 'failed': 0, 'throttled': 0})
+                result['latencies'].append(latency)
+                if status == 429:
+                    result['throttled'] += 1
+                elif status != 200:
+                    result['failed'] += 1
+
+    threads = [threading.Thread(target=worker, args=(client,)) for client in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def summary(results, duration):
+    rows = {}
+    all_latencies = []
+    for operation, result in sorted(results.items()):
+        latencies = result['latencies']
+        all_latencies.extend(latencies)
+        rows[operation] = percentiles(latencies, duration, result['failed'], result['throttled'])
+
+    rows['total'] = percentiles(all_latencies, duration, sum(r['failed'] for r in results.values()),
+                                sum(r['throttled'] for r in results.values()))
+    return rows
+
+
+def percentiles(latencies, duration, failed, throttled):
+    # quantiles needs at least 2 values
+    cuts = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [latencies[0] if latencies else 0.0] * 99
+    return {'requests': len(latencies), 'per_second': len(latencies) / duration, 'p50_ms': cuts[49] * 1000,
+            'p95_ms': cuts[94] * 1000, 'p99_ms': cuts[98] * 1000, 'failed': failed, 'throttled': throttled}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput and latency of the api under a marketplace workload')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients, each one a different buyer')
+    parser.add_argument('--duration', type=float, default=60, help='seconds measured')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds run before measuring')
+    parser.add_argument('--products', default='1-3', help='product ids used, e.g. 1,2,5-100')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='weights of the operations')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default=None, help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    unknown = set(mix) - {'browse', 'threads', 'campaigns', 'login', 'checkout', 'rating', 'question', 'subscribe'}
+    if unknown:
+        parser.error(f'unknown operations in --mix: {", ".join(sorted(unknown))}')
+
+    random.seed(args.seed)
+    run_id = uuid.uuid4().hex[:8]
+
+    print(f'registering and logging in {args.clients} buyers')
+    users, campaigns = setup(args.url, run_id, args.clients, parse_ids(args.products))
+    if not campaigns and mix.pop('subscribe', None):
+        print('no campaign is running, subscribe removed from the mix')
+
+    print(f'{args.clients} clients, {args.warmup:.0f}s warmup, {args.duration:.0f}s measured, mix {args.mix}')
+    rows = summary(run(users, mix, args.duration, args.warmup), args.duration)
+
+    print(f'{"operation":>10} {"requests":>9} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+          f'{"failed":>7} {"429":>6}')
+    for operation, row in rows.items():
+        print(f'{operation:>10} {row["requests"]:>9} {row["per_second"]:>8.1f} {row["p50_ms"]:>8.1f} '
+              f'{row["p95_ms"]:>8.1f} {row["p99_ms"]:>8.1f} {row["failed"]:>7} {row["throttled"]:>6}')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'run_id': run_id, 'clients': args.clients, 'duration': args.duration, 'mix': args.mix,
+                       'results': rows}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Concurrency test of the question id allocation of POST /dbproj/questions/<product_id>
+
+Creates <products> products and posts <questions> questions about random products from <workers> connections
+at the same time, numbering them with next_question_id and inserting them as the api does, then checks that
+every product got the ids 1..n without gaps, and reports the throughput.
+
+Everything created is deleted at the end, except the notifications already created by a running api's outbox
+worker for the seller of the products. Run it against a test database, as a user that can delete rows:
+
+    python benchmarks/question_ids.py --dsn "dbname=dbproj user=postgres host=127.0.0.1" --workers 16
+"""
+
+import argparse
+import random
+import threading
+import time
+import psycopg2
+
+FIRST_PRODUCT_ID = 3000000
+SELLER_ID = 1
+USER_ID = 2
+
+
+def setup(conn, products):
+    cur = conn.cursor()
+
+    cur.execute("insert into products "
+                "select i, timestamp '2022-01-01 00:00:00', 'bench product', 1.0, 100, 'bench', %s "
+                "from generate_series(%s, %s) as i;",
+                (SELLER_ID, FIRST_PRODUCT_ID, FIRST_PRODUCT_ID + products - 1))
+    conn.commit()
+
+
+def cleanup(conn, products):
+    cur = conn.cursor()
+    last_product_id = FIRST_PRODUCT_ID + products - 1
+
+    cur.execute('delete from notification_outbox '
+                "where event_type = 'question' and (payload ->> 'product_id')::int between %s and %s;",
+                (FIRST_PRODUCT_ID, last_product_id))
+    cur.execute('delete from questions where products_product_id between %s and %s;',
+                (FIRST_PRODUCT_ID, last_product_id))
+    cur.execute('delete from product_question_counters where products_product_id between %s and %s;',
+                (FIRST_PRODUCT_ID, last_product_id))
+    cur.execute('delete from products where product_id between %s and %s;', (FIRST_PRODUCT_ID, last_product_id))
+    conn.commit()
+
+
+def post_questions(dsn, products, questions, errors):
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+
+    try:
+        for _ in range(questions):
+            product_id = FIRST_PRODUCT_ID + random.randrange(products)
+            try:
+                cur.execute('select next_question_id(%s);', (product_id,))
+                question_id = cur.fetchone()[0]
+                cur.execute('insert into questions (question_id, question_text, users_user_id, products_product_id, '
+                            "products_version) values (%s, 'bench question', %s, %s, timestamp '2022-01-01 00:00:00');",
+                            (question_id, USER_ID, product_id))
+                conn.commit()
+            except psycopg2.DatabaseError as error:
+                conn.rollback()
+                errors.append(str(error))
+
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Question id allocation under concurrency')
+    parser.add_argument('--dsn', default='dbname=dbproj user=postgres host=127.0.0.1')
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--questions', type=int, default=20000, help='total questions posted')
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        setup(conn, args.products)
+
+        errors = []
+        threads = [threading.Thread(target=post_questions,
+                                    args=(args.dsn, args.products, args.questions // args.workers, errors))
+                   for _ in range(args.workers)]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        # the ids of each product must be exactly 1..n
+        cur = conn.cursor()
+        cur.execute('select count(*) from ('
+                    'select products_product_id from questions where products_product_id between %s and %s '
+                    'group by products_product_id having max(question_id) <> count(*) or min(question_id) <> 1'
+                    ') as gaps;',
+                    (FIRST_PRODUCT_ID, FIRST_PRODUCT_ID + args.products - 1))
+        products_with_gaps = cur.fetchone()[0]
+        conn.commit()
+
+        posted = (args.questions // args.workers) * args.workers - len(errors)
+        print(f'{posted} questions about {args.products} products by {args.workers} workers '
+              f'in {elapsed:.2f}s ({posted / elapsed:.0f} questions/s)')
+        print(f'errors: {len(errors)}, products with gaps or repeated ids: {products_with_gaps}')
+        for error in errors[:5]:
+            print(f'  {error.strip()}')
+
+    finally:
+        conn.rollback()
+        cleanup(conn, args.products)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
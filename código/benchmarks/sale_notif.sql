@@ -0,0 +1,53 @@
+-- Benchmark of the sale_notif trigger on orders with many sellers
+--
+-- Creates <sellers> sellers with one product each and an order with one product of each seller,
+-- times the update of the order total (which fires sale_notif), then the processing of the outbox event it
+-- queues, and rolls everything back
+--
+-- psql -h localhost -U postgres -d dbproj -v sellers=1000 -f benchmarks/sale_notif.sql
+
+\if :{?sellers}
+\else
+    \set sellers 1000
+\endif
+
+begin;
+
+insert into users
+select 1000000 + i, 'bench_seller_' || i, 'x', 'bench@bench.pt'
+from generate_series(1, :sellers) as i;
+
+insert into sellers
+select 1000000 + i, 123456789, 'bench'
+from generate_series(1, :sellers) as i;
+
+-- two versions of every product, so that joining on the product id alone would double the fan-out
+insert into products
+select 1000000 + i, v, 'bench product', 1.0, 100, 'bench', 1000000 + i
+from generate_series(1, :sellers) as i,
+     (values (timestamp '2022-01-01 00:00:00'), (timestamp '2022-02-01 00:00:00')) as versions(v);
+
+insert into orders values (1000000, current_date, 0, null, null, 2);
+
+insert into product_quantities
+select 1, 1000000, 1000000 + i, timestamp '2022-02-01 00:00:00'
+from generate_series(1, :sellers) as i;
+
+\timing on
+update orders set price_total = :sellers where id = 1000000;
+\timing off
+
+select count(*) as sellers_orders from sellers_orders where orders_id = 1000000;
+-- the trigger only queues the sale in the outbox; the notifications are created by the outbox worker
+select count(*) as outbox_events
+from notification_outbox
+where event_type = 'sale' and (payload ->> 'order_id')::int = 1000000 and processed_at is null;
+
+-- time the processing of the queued events (including any other pending ones) and count the notifications
+\timing on
+select process_notification_outbox(1000000) as processed_events;
+\timing off
+
+select count(*) as notifications from notifications where content like 'New order n.1000000 %';
+
+rollback;
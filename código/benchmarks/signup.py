@@ -0,0 +1,85 @@
+"""
+Benchmark of concurrent registrations (POST /dbproj/user/)
+
+Registers <signups> buyers through a running api with 1, 2, 4, ... concurrent clients and reports the
+registrations per second and the latency percentiles for each number of clients. The users created are not
+deleted (their usernames start with 'bench_<run id>_'), so run it against a test database:
+
+    python benchmarks/signup.py --url http://127.0.0.1:8080 --signups 500 --max-clients 32
+"""
+
+import argparse
+import itertools
+import json
+import statistics
+import threading
+import time
+import urllib.request
+import uuid
+
+
+def register(url, username):
+    payload = {'username': username, 'password': 'bench-password', 'email': f'{username}@bench.pt',
+               'type': 'buyers', 'nif': 123456789, 'home_addr': 'bench'}
+    request = urllib.request.Request(f'{url}/dbproj/user/', data=json.dumps(payload).encode(), method='POST',
+                                     headers={'Content-Type': 'application/json'})
+
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        body = json.loads(response.read())
+
+    return time.perf_counter() - start, body['status'] == 200
+
+
+def run(url, run_id, signups, clients):
+    usernames = iter([f'bench_{run_id}_{clients}_{i}' for i in range(signups)])
+    lock = threading.Lock()
+    latencies = []
+    failures = []
+
+    def client():
+        while True:
+            with lock:
+                username = next(usernames, None)
+            if username is None:
+                return
+
+            latency, ok = register(url, username)
+            with lock:
+                latencies.append(latency)
+                if not ok:
+                    failures.append(username)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    percentiles = statistics.quantiles(latencies, n=100)
+    return elapsed, len(failures), percentiles[49], percentiles[94], percentiles[98]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Registration throughput by number of concurrent clients')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--signups', type=int, default=500, help='registrations per number of clients')
+    parser.add_argument('--max-clients', type=int, default=32)
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+
+    print(f'{args.signups} registrations per run')
+    print(f'{"clients":>8} {"signups/s":>10} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"failed":>7}')
+
+    for clients in itertools.takewhile(lambda c: c <= args.max_clients, (2 ** i for i in itertools.count())):
+        elapsed, failed, p50, p95, p99 = run(args.url, run_id, args.signups, clients)
+        print(f'{clients:>8} {args.signups / elapsed:>10.1f} {p50 * 1000:>8.1f} {p95 * 1000:>8.1f} '
+              f'{p99 * 1000:>8.1f} {failed:>7}')
+
+
+if __name__ == '__main__':
+    main()
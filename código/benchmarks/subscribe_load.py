@@ -0,0 +1,140 @@
+"""
+Load test of campaign subscriptions during a launch-time stampede
+
+Creates a campaign with <subscriptions> coupons and as many buyers, then subscribes all of them with
+subscribe_coupon (the function used by PUT /dbproj/subscribe/<campaign_id>) using 1, 2, 4, ... worker
+connections, and reports the subscription throughput for each worker count. The campaign's coupons can be
+split across a different number of counter rows with --shards (1 reproduces the single-row counter).
+
+Campaigns can't overlap, so the campaign runs on the day after the last campaign of the database, and the
+subscriptions are made as if on that day. Everything created is deleted at the end. Run it against a test
+database, as a user that can delete rows:
+
+    python benchmarks/subscribe_load.py --dsn "dbname=dbproj user=postgres host=127.0.0.1" --shards 16
+"""
+
+import argparse
+import itertools
+import threading
+import time
+import psycopg2
+
+CAMPAIGN_ID = 1000000
+
+
+# Returns the id of the first buyer created (after the users of the database) and the day of the campaign
+def setup(conn, subscriptions):
+    cur = conn.cursor()
+
+    cur.execute('select coalesce(max(user_id), 0) + 1 from users;')
+    first_buyer_id = cur.fetchone()[0]
+    cur.execute('select greatest(max(date_end), current_date) + 1 from campaigns;')
+    campaign_day = cur.fetchone()[0]
+
+    cur.execute("insert into users "
+                "select i, 'bench_buyer_' || i, 'x', 'bench@bench.pt' from generate_series(%s, %s) as i;",
+                (first_buyer_id, first_buyer_id + subscriptions - 1))
+    cur.execute("insert into buyers select i, 123456789, 'bench' from generate_series(%s, %s) as i;",
+                (first_buyer_id, first_buyer_id + subscriptions - 1))
+    cur.execute("insert into campaigns "
+                "values (%s, 'bench campaign', %s, %s, %s, 10, (select min(users_user_id) from admins));",
+                (CAMPAIGN_ID, campaign_day, campaign_day, subscriptions))
+    conn.commit()
+
+    return first_buyer_id, campaign_day
+
+
+def reset(conn, subscriptions, shards):
+    cur = conn.cursor()
+
+    cur.execute('delete from coupons where campaigns_campaign_id = %s;', (CAMPAIGN_ID,))
+    cur.execute('delete from campaign_coupon_shards where campaigns_campaign_id = %s;', (CAMPAIGN_ID,))
+    cur.execute('insert into campaign_coupon_shards '
+                'select %s, i, %s / %s + (case when i < %s %% %s then 1 else 0 end) '
+                'from generate_series(0, %s - 1) as i;',
+                (CAMPAIGN_ID, subscriptions, shards, subscriptions, shards, shards))
+    conn.commit()
+
+
+def cleanup(conn, first_buyer_id):
+    cur = conn.cursor()
+
+    cur.execute('delete from coupons where campaigns_campaign_id = %s;', (CAMPAIGN_ID,))
+    cur.execute('delete from campaign_coupon_shards where campaigns_campaign_id = %s;', (CAMPAIGN_ID,))
+    cur.execute('delete from campaigns where campaign_id = %s;', (CAMPAIGN_ID,))
+    cur.execute('delete from buyers where users_user_id >= %s;', (first_buyer_id,))
+    cur.execute('delete from users where user_id >= %s;', (first_buyer_id,))
+    conn.commit()
+
+
+def subscribe(dsn, campaign_day, buyers, failures):
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+
+    try:
+        for buyer_id in buyers:
+            # subscribed at noon of the campaign's day
+            cur.execute("select subscribe_coupon(%s, %s, %s + time '12:00', %s + 30);",
+                        (CAMPAIGN_ID, buyer_id, campaign_day, campaign_day))
+            if cur.fetchone()[0] is None:
+                failures.append(buyer_id)
+            conn.commit()
+
+    finally:
+        conn.close()
+
+
+def run(dsn, campaign_day, first_buyer_id, subscriptions, workers):
+    # the buyer ids are shared by all the workers; next() on the iterator is protected by a lock
+    ids = iter(range(first_buyer_id, first_buyer_id + subscriptions))
+    lock = threading.Lock()
+
+    def buyers():
+        while True:
+            with lock:
+                buyer_id = next(ids, None)
+            if buyer_id is None:
+                return
+            yield buyer_id
+
+    failures = []
+    threads = [threading.Thread(target=subscribe, args=(dsn, campaign_day, buyers(), failures))
+               for _ in range(workers)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return elapsed, len(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Campaign subscription throughput by number of workers')
+    parser.add_argument('--dsn', default='dbname=dbproj user=postgres host=127.0.0.1')
+    parser.add_argument('--subscriptions', type=int, default=5000)
+    parser.add_argument('--shards', type=int, default=16, help='coupon counter rows of the campaign')
+    parser.add_argument('--max-workers', type=int, default=32)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    first_buyer_id, campaign_day = setup(conn, args.subscriptions)
+    try:
+        print(f'{args.subscriptions} subscriptions, {args.shards} shard(s)')
+        print(f'{"workers":>8} {"seconds":>9} {"subs/s":>9} {"failed":>7}')
+
+        for workers in itertools.takewhile(lambda w: w <= args.max_workers, (2 ** i for i in itertools.count())):
+            reset(conn, args.subscriptions, args.shards)
+            elapsed, failed = run(args.dsn, campaign_day, first_buyer_id, args.subscriptions, workers)
+            print(f'{workers:>8} {elapsed:>9.2f} {args.subscriptions / elapsed:>9.0f} {failed:>7}')
+
+    finally:
+        conn.rollback()
+        cleanup(conn, first_buyer_id)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -15,4 +15,10 @@ GRANT CONNECT ON DATABASE dbproj TO projuser;
 
 REVOKE ALL ON ALL TABLES IN SCHEMA public FROM PUBLIC;
 
-GRANT SELECT, INSERT, UPDATE ON ALL TABLES IN SCHEMA public TO projuser;
\ No newline at end of file
+GRANT SELECT, INSERT, UPDATE ON ALL TABLES IN SCHEMA public TO projuser;
+
+-- the retention job (notification_retention.py) removes old notifications and processed outbox events, and the
+-- api deletes the expired refresh tokens
+GRANT DELETE ON notifications, notification_outbox, refresh_tokens TO projuser;
+
+GRANT USAGE ON ALL SEQUENCES IN SCHEMA public TO projuser;
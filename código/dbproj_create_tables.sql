@@ -3,17 +3,22 @@ drop table if exists buyers cascade;
 drop table if exists campaigns cascade;
 drop table if exists computers cascade;
 drop table if exists coupons cascade;
+drop table if exists campaign_coupon_shards cascade;
 drop table if exists notifications cascade;
+drop table if exists notification_outbox cascade;
+drop table if exists notifications_archive cascade;
 drop table if exists orders cascade;
 drop table if exists product_quantities cascade;
 drop table if exists products cascade;
 drop table if exists questions cascade;
+drop table if exists product_question_counters cascade;
 drop table if exists ratings cascade;
 drop table if exists sellers cascade;
 drop table if exists sellers_orders cascade;
 drop table if exists smartphones cascade;
 drop table if exists televisions cascade;
 drop table if exists users cascade;
+drop table if exists refresh_tokens cascade;
 
 /* Create table products */
 CREATE TABLE products (
@@ -64,13 +69,23 @@ CREATE TABLE smartphones (
 
 /* Create table users */
 CREATE TABLE users (
-	user_id	 INTEGER,
+	user_id	 SERIAL,
 	username VARCHAR(512) UNIQUE NOT NULL,
 	password VARCHAR(512) NOT NULL,
 	email VARCHAR(512) NOT NULL,
 	PRIMARY KEY(user_id)
 );
 
+/* Create table refresh_tokens */
+CREATE TABLE refresh_tokens (
+	token_hash	 CHAR(64),
+	users_user_id INTEGER NOT NULL,
+	expires_at	 TIMESTAMP WITH TIME ZONE NOT NULL,
+	revoked	 BOOL NOT NULL DEFAULT false,
+	rotated	 BOOL NOT NULL DEFAULT false,
+	PRIMARY KEY(token_hash)
+);
+
 /* Create table admins */
 CREATE TABLE admins (
 	users_user_id INTEGER,
@@ -127,9 +142,16 @@ CREATE TABLE questions (
 	PRIMARY KEY(question_id,products_product_id)
 );
 
+/* Create table product_question_counters */
+CREATE TABLE product_question_counters (
+	products_product_id INTEGER,
+	last_question_id	 INTEGER NOT NULL,
+	PRIMARY KEY(products_product_id)
+);
+
 /* Create table campaigns */
 CREATE TABLE campaigns (
-	campaign_id		 INTEGER,
+	campaign_id		 SERIAL,
 	description		 VARCHAR(512) NOT NULL,
 	date_start		 DATE NOT NULL,
 	date_end		 DATE NOT NULL,
@@ -141,25 +163,57 @@ CREATE TABLE campaigns (
 
 /* Create table coupons */
 CREATE TABLE coupons (
-	coupon_id		 INTEGER,
+	coupon_id		 SERIAL,
 	used			 BOOL NOT NULL,
 	discount_applied	 DOUBLE PRECISION,
 	expiration_date DATE NOT NULL,
 	campaigns_campaign_id INTEGER,
 	buyers_users_user_id	 INTEGER NOT NULL,
 	orders_id		 INTEGER,
-	PRIMARY KEY(coupon_id,campaigns_campaign_id)
+	expired		 BOOL NOT NULL DEFAULT false,
+	PRIMARY KEY(coupon_id,campaigns_campaign_id),
+	UNIQUE(campaigns_campaign_id,buyers_users_user_id)
+);
+
+/* Create table campaign_coupon_shards */
+CREATE TABLE campaign_coupon_shards (
+	campaigns_campaign_id INTEGER,
+	shard			 SMALLINT,
+	remaining		 INTEGER NOT NULL,
+	PRIMARY KEY(campaigns_campaign_id,shard)
 );
 
 /* Create table notifications */
 CREATE TABLE notifications (
-	notification_id INTEGER,
+	notification_id SERIAL,
 	users_user_id	 INTEGER NOT NULL,
 	content	 VARCHAR(512) NOT NULL,
 	notif_time		 TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
+	read			 BOOL NOT NULL DEFAULT false,
 	PRIMARY KEY(notification_id, users_user_id)
 );
 
+/* Create table notifications_archive */
+CREATE TABLE notifications_archive (
+	notification_id INTEGER,
+	users_user_id	 INTEGER NOT NULL,
+	content	 VARCHAR(512) NOT NULL,
+	notif_time		 TIMESTAMP WITH TIME ZONE NOT NULL,
+	read			 BOOL NOT NULL,
+	archived_at	 TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
+	PRIMARY KEY(notification_id, users_user_id)
+);
+
+/* Create table notification_outbox */
+CREATE TABLE notification_outbox (
+	event_id	 BIGSERIAL,
+	event_type	 VARCHAR(32) NOT NULL,
+	payload	 JSONB NOT NULL,
+	created_at	 TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
+	processed_at TIMESTAMP WITH TIME ZONE,
+	PRIMARY KEY(event_id)
+);
+
 /* Create table product_quantities */
 CREATE TABLE product_quantities (
 	quantity		 INTEGER NOT NULL,
@@ -180,6 +234,7 @@ ALTER TABLE products ADD CONSTRAINT products_fk1 FOREIGN KEY (sellers_users_user
 ALTER TABLE computers ADD CONSTRAINT computers_fk1 FOREIGN KEY (products_product_id, products_version) REFERENCES products(product_id, version);
 ALTER TABLE televisions ADD CONSTRAINT televisions_fk1 FOREIGN KEY (products_product_id, products_version) REFERENCES products(product_id, version);
 ALTER TABLE smartphones ADD CONSTRAINT smartphones_fk1 FOREIGN KEY (products_product_id, products_version) REFERENCES products(product_id, version);
+ALTER TABLE refresh_tokens ADD CONSTRAINT refresh_tokens_fk1 FOREIGN KEY (users_user_id) REFERENCES users(user_id);
 ALTER TABLE admins ADD CONSTRAINT admins_fk1 FOREIGN KEY (users_user_id) REFERENCES users(user_id);
 ALTER TABLE sellers ADD CONSTRAINT sellers_fk1 FOREIGN KEY (users_user_id) REFERENCES users(user_id);
 ALTER TABLE buyers ADD CONSTRAINT buyers_fk1 FOREIGN KEY (users_user_id) REFERENCES users(user_id);
@@ -192,6 +247,8 @@ ALTER TABLE questions ADD CONSTRAINT questions_fk1 FOREIGN KEY (users_user_id) R
 ALTER TABLE questions ADD CONSTRAINT questions_fk3 FOREIGN KEY (products_product_id, products_version) REFERENCES products(product_id, version);
 ALTER TABLE questions ADD CONSTRAINT questions_fk5 FOREIGN KEY (questions_question_id, products_product_id) REFERENCES questions(question_id, products_product_id);
 ALTER TABLE campaigns ADD CONSTRAINT campaigns_fk1 FOREIGN KEY (admins_users_user_id) REFERENCES admins(users_user_id);
+ALTER TABLE campaigns ADD CONSTRAINT campaigns_no_overlap EXCLUDE USING gist (daterange(date_start, date_end, '[]') WITH &&);
+ALTER TABLE campaign_coupon_shards ADD CONSTRAINT campaign_coupon_shards_fk1 FOREIGN KEY (campaigns_campaign_id) REFERENCES campaigns(campaign_id);
 ALTER TABLE coupons ADD CONSTRAINT coupons_fk1 FOREIGN KEY (campaigns_campaign_id) REFERENCES campaigns(campaign_id);
 ALTER TABLE coupons ADD CONSTRAINT coupons_fk2 FOREIGN KEY (buyers_users_user_id) REFERENCES buyers(users_user_id);
 ALTER TABLE coupons ADD CONSTRAINT coupons_fk3 FOREIGN KEY (orders_id) REFERENCES orders(id);
@@ -201,3 +258,11 @@ ALTER TABLE product_quantities ADD CONSTRAINT product_quantities_fk2 FOREIGN KEY
 ALTER TABLE sellers_orders ADD CONSTRAINT sellers_orders_fk1 FOREIGN KEY (sellers_users_user_id) REFERENCES sellers(users_user_id);
 ALTER TABLE sellers_orders ADD CONSTRAINT sellers_orders_fk2 FOREIGN KEY (orders_id) REFERENCES orders(id);
 
+CREATE INDEX orders_order_date_idx ON orders (order_date);
+CREATE INDEX notifications_users_time_idx ON notifications (users_user_id, notif_time, notification_id);
+CREATE INDEX notifications_users_id_idx ON notifications (users_user_id, notification_id);
+CREATE INDEX notification_outbox_pending_idx ON notification_outbox (event_id) WHERE processed_at IS NULL;
+CREATE INDEX coupons_pending_expiration_idx ON coupons (expiration_date) WHERE NOT used AND NOT expired;
+CREATE INDEX questions_thread_idx ON questions (products_product_id, questions_question_id);
+CREATE INDEX refresh_tokens_users_idx ON refresh_tokens (users_user_id) WHERE NOT revoked;
+CREATE INDEX refresh_tokens_expires_idx ON refresh_tokens (expires_at);
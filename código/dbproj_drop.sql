@@ -3,23 +3,40 @@
 drop function if exists q_notif() cascade;
 drop function if exists sale_notif() cascade;
 drop function if exists rating_notif() cascade;
+drop function if exists notif_push() cascade;
+drop function if exists campaign_shards() cascade;
+drop function if exists subscribe_coupon(int, int, timestamp, date) cascade;
+drop function if exists expire_coupons(int) cascade;
+drop function if exists next_question_id(int) cascade;
+drop function if exists process_notification_outbox(int) cascade;
+drop function if exists prune_notifications(interval, int, int, bool) cascade;
+drop function if exists prune_notifications(interval, int, bool) cascade;
+drop function if exists prune_notifications_over_cap(int[], int, int, bool) cascade;
+drop function if exists remove_notifications(int[], int[], bool) cascade;
+drop function if exists prune_notification_outbox(interval, int) cascade;
+drop function if exists prune_refresh_tokens(int) cascade;
 
 drop table if exists admins cascade;
 drop table if exists buyers cascade;
 drop table if exists campaigns cascade;
 drop table if exists computers cascade;
 drop table if exists coupons cascade;
+drop table if exists campaign_coupon_shards cascade;
 drop table if exists notifications cascade;
+drop table if exists notification_outbox cascade;
+drop table if exists notifications_archive cascade;
 drop table if exists orders cascade;
 drop table if exists product_quantities cascade;
 drop table if exists products cascade;
 drop table if exists questions cascade;
+drop table if exists product_question_counters cascade;
 drop table if exists ratings cascade;
 drop table if exists sellers cascade;
 drop table if exists sellers_orders cascade;
 drop table if exists smartphones cascade;
 drop table if exists televisions cascade;
 drop table if exists users cascade;
+drop table if exists refresh_tokens cascade;
 
 REVOKE ALL ON ALL TABLES IN SCHEMA public FROM projuser;
 REVOKE CONNECT ON DATABASE dbproj FROM projuser;
@@ -23,93 +23,184 @@ end;
 $$;
 
 
-create or replace function q_notif() returns trigger
+create or replace function campaign_shards() returns trigger
     language plpgsql
 as
 $$
 declare
-    parent_user_id questions.questions_users_user_id%type;
-    notif_id       notifications.notification_id%type;
-    user_id        sellers.users_user_id%type;
+    shards int;
 begin
-    parent_user_id := new.questions_users_user_id;
-    select sellers_users_user_id into user_id from products where product_id = new.products_product_id;
-    select max(notification_id) into notif_id from notifications where users_user_id = user_id;
+    -- the coupons of a campaign are split across up to 16 counter rows, so that simultaneous subscriptions
+    -- don't all wait for the lock of a single row (a campaign without coupons still gets one, empty, row)
+    shards := greatest(least(new.coupons, 16), 1);
 
-    if notif_id is NULL then
-        notif_id := 0;
-    else
-        notif_id := notif_id + 1;
+    insert into campaign_coupon_shards (campaigns_campaign_id, shard, remaining)
+    select new.campaign_id, i, new.coupons / shards + (case when i < new.coupons % shards then 1 else 0 end)
+    from generate_series(0, shards - 1) as i;
+
+    return new;
+end;
+$$;
+
+
+create or replace function subscribe_coupon(campaign int, buyer int, subscribed_at timestamp,
+                                            expiration date) returns int
+    language plpgsql
+as
+$$
+declare
+    shard_id campaign_coupon_shards.shard%type;
+    coupon   coupons.coupon_id%type;
+begin
+    -- claim a coupon from a random shard (of a campaign running on the day of the subscription, its last day
+    -- included) that still has coupons, skipping the ones locked by other subscriptions
+    select cs.shard
+    into shard_id
+    from campaign_coupon_shards as cs
+             join campaigns as c on c.campaign_id = cs.campaigns_campaign_id
+    where cs.campaigns_campaign_id = campaign
+      and subscribed_at::date between c.date_start and c.date_end
+      and cs.remaining > 0
+    order by random()
+    limit 1 for update of cs skip locked;
+
+    -- all the shards with coupons left are locked: wait for one of them
+    if shard_id is null then
+        select cs.shard
+        into shard_id
+        from campaign_coupon_shards as cs
+                 join campaigns as c on c.campaign_id = cs.campaigns_campaign_id
+        where cs.campaigns_campaign_id = campaign
+          and subscribed_at::date between c.date_start and c.date_end
+          and cs.remaining > 0
+        limit 1 for update of cs;
     end if;
 
-    insert into notifications
-    values (notif_id, user_id,
-            CONCAT('New comment n.', new.question_id, ' regarding your product n.', new.products_product_id, ': ''',
-                   new.question_text, ''''));
-
-    if parent_user_id is not NULL then
-        select max(notification_id) into notif_id from notifications where users_user_id = user_id;
-        if notif_id is NULL then
-            notif_id := 0;
-        else
-            notif_id := notif_id + 1;
-        end if;
-        insert into notifications
-        values (notif_id, parent_user_id,
-                CONCAT('New reply n.', new.question_id, ' to your comment n.', new.questions_question_id,
-                       ' on product n.', new.products_product_id, ': ''', new.question_text, ''''));
+    -- the campaign doesn't exist, isn't running or has no coupons left
+    if shard_id is null then
+        return null;
     end if;
 
-    return new;
+    update campaign_coupon_shards
+    set remaining = remaining - 1
+    where campaigns_campaign_id = campaign
+      and shard = shard_id;
+
+    insert into coupons (used, discount_applied, expiration_date, campaigns_campaign_id, buyers_users_user_id)
+    values (false, 0, expiration, campaign, buyer)
+    returning coupon_id into coupon;
+
+    return coupon;
 end;
 $$;
 
 
-create or replace function sale_notif() returns trigger
+create or replace function expire_coupons(batch_size int) returns int
     language plpgsql
 as
 $$
 declare
-    notif_id       notifications.notification_id%type;
-    total       orders.price_total%type;
-    buyer_id    orders.buyers_users_user_id%type;
-    campaign_id orders.coupons_campaigns_campaign_id%type;
-    sellers cursor for
-        select distinct sellers_users_user_id
-		from product_quantities as pq, products as p
-		where pq.orders_id = new.id and pq.products_product_id = p.product_id;
+    expired_count int;
 begin
-    total := new.price_total;
-    buyer_id := new.buyers_users_user_id;
-    campaign_id := new.coupons_campaigns_campaign_id;
-
-    for line in sellers
-	loop
-        select max(notification_id) into notif_id from notifications where users_user_id = line.sellers_users_user_id;
-        if notif_id is NULL then
-            notif_id := 0;
-        else
-            notif_id := notif_id + 1;
-        end if;
-
-        insert into sellers_orders
-        values (line.sellers_users_user_id, new.id);
-
-		insert into notifications
-        values (notif_id, line.sellers_users_user_id,
-            CONCAT('New order n.', new.id, ' including your products'));
-	end loop;
-
-
-    select max(notification_id) into notif_id from notifications where users_user_id = buyer_id;
-    if notif_id is NULL then
-        notif_id := 0;
-    else
-        notif_id := notif_id + 1;
+    -- marks one batch of the unused coupons whose expiration date has passed as expired; the coupons of campaigns
+    -- that are still running are given back to the campaign, so that other buyers can subscribe them
+    with expiring as (
+        select coupon_id, campaigns_campaign_id
+        from coupons
+        where not used
+          and not expired
+          and expiration_date <= CURRENT_DATE
+        order by expiration_date
+        limit batch_size for update skip locked
+    ),
+         expired_coupons as (
+             update coupons as c
+                 set expired = true
+                 from expiring as e
+                 where c.coupon_id = e.coupon_id and c.campaigns_campaign_id = e.campaigns_campaign_id
+                 returning c.campaigns_campaign_id
+         ),
+         returned_coupons as (
+             select ec.campaigns_campaign_id, count(*) as coupons
+             from expired_coupons as ec
+                      join campaigns as ca on ca.campaign_id = ec.campaigns_campaign_id
+             where ca.date_end >= CURRENT_DATE
+             group by ec.campaigns_campaign_id
+         ),
+         returned as (
+             update campaign_coupon_shards as cs
+                 set remaining = remaining + rc.coupons
+                 from returned_coupons as rc
+                 where cs.campaigns_campaign_id = rc.campaigns_campaign_id and cs.shard = 0
+         )
+    select count(*)
+    into expired_count
+    from expired_coupons;
+
+    return expired_count;
+end;
+$$;
+
+
+create or replace function next_question_id(product int) returns int
+    language plpgsql
+as
+$$
+declare
+    question questions.question_id%type;
+begin
+    -- the row lock of the product's counter is held until the end of the transaction that posts the question
+    update product_question_counters
+    set last_question_id = last_question_id + 1
+    where products_product_id = product
+    returning last_question_id into question;
+
+    -- first question since the counter was created: start from the questions that already exist
+    if question is null then
+        insert into product_question_counters
+        select product, coalesce(max(question_id), 0) + 1
+        from questions
+        where products_product_id = product
+        on conflict (products_product_id) do update set last_question_id = product_question_counters.last_question_id + 1
+        returning last_question_id into question;
     end if;
-    insert into notifications
-    values (notif_id, buyer_id,
-            CONCAT('Your order n.', new.id, ' for a total of ', new.price_total, ' has been confirmed'));
+
+    return question;
+end;
+$$;
+
+
+-- The notification triggers only append a compact event to notification_outbox;
+-- the notifications are created later, in batches, by process_notification_outbox (called by the api worker)
+
+create or replace function q_notif() returns trigger
+    language plpgsql
+as
+$$
+begin
+    insert into notification_outbox (event_type, payload)
+    values ('question', json_build_object('product_id', new.products_product_id, 'question_id', new.question_id));
+
+    return new;
+end;
+$$;
+
+
+create or replace function sale_notif() returns trigger
+    language plpgsql
+as
+$$
+begin
+    -- sellers_orders is part of the order, so it is still filled in synchronously
+    insert into sellers_orders
+    select distinct p.sellers_users_user_id, new.id
+    from product_quantities as pq
+             join products as p on p.product_id = pq.products_product_id and p.version = pq.products_version
+    where pq.orders_id = new.id
+    on conflict do nothing;
+
+    insert into notification_outbox (event_type, payload)
+    values ('sale', json_build_object('order_id', new.id));
 
     return new;
 end;
@@ -120,24 +211,233 @@ create or replace function rating_notif() returns trigger
     language plpgsql
 as
 $$
+begin
+    insert into notification_outbox (event_type, payload)
+    values ('rating', json_build_object('order_id', new.orders_id, 'product_id', new.products_product_id,
+                                        'version', new.products_version));
+
+    return new;
+end;
+$$;
+
+
+create or replace function process_notification_outbox(batch_size int) returns int
+    language plpgsql
+as
+$$
 declare
-    notif_id       notifications.notification_id%type;
-    seller_id sellers.users_user_id%type;
+    event_ids bigint[];
 begin
-    select sellers_users_user_id into seller_id from products where product_id = new.products_product_id;
+    -- claim the oldest pending events, skipping the ones being processed by other workers
+    select array_agg(event_id)
+    into event_ids
+    from (select event_id
+          from notification_outbox
+          where processed_at is null
+          order by event_id
+          limit batch_size for update skip locked) as batch;
 
-    select max(notification_id) into notif_id from notifications where users_user_id = seller_id;
-    if notif_id is NULL then
-        notif_id := 0;
-    else
-        notif_id := notif_id + 1;
+    if event_ids is null then
+        return 0;
     end if;
 
-    insert into notifications
-    values (notif_id, seller_id,
-            CONCAT('Your product n.', new.products_product_id, ' (version ', new.products_version,
-                ') has been rated a ', new.rating,
-                ' with the comment ''', new.comment, ''''));
+    -- the batches insert their notifications one at a time, so that the notification ids are committed in
+    -- increasing order and a client polling for the ids after the last one it got (GET /dbproj/inbox?since=)
+    -- never skips one committed later with a lower id; the lock is held until the end of the transaction
+    perform pg_advisory_xact_lock(hashtext('process_notification_outbox'));
+
+    -- the notifications are dated when their event happened, not when the (possibly late) batch is processed
+    insert into notifications (users_user_id, content, notif_time)
+    select users_user_id, content, created_at
+    from (
+             -- seller of the product of a question
+             select e.event_id, e.created_at, p.sellers_users_user_id as users_user_id,
+                    CONCAT('New comment n.', q.question_id, ' regarding your product n.', q.products_product_id,
+                           ': ''', q.question_text, '''') as content
+             from notification_outbox as e
+                      join questions as q on q.products_product_id = (e.payload ->> 'product_id')::int
+                 and q.question_id = (e.payload ->> 'question_id')::int
+                      join products as p on p.product_id = q.products_product_id and p.version = q.products_version
+             where e.event_id = any (event_ids) and e.event_type = 'question'
+             union all
+             -- author of the question that was replied to
+             select e.event_id, e.created_at, q.questions_users_user_id,
+                    CONCAT('New reply n.', q.question_id, ' to your comment n.', q.questions_question_id,
+                           ' on product n.', q.products_product_id, ': ''', q.question_text, '''')
+             from notification_outbox as e
+                      join questions as q on q.products_product_id = (e.payload ->> 'product_id')::int
+                 and q.question_id = (e.payload ->> 'question_id')::int
+             where e.event_id = any (event_ids) and e.event_type = 'question'
+               and q.questions_users_user_id is not null
+             union all
+             -- sellers of the products of an order
+             select e.event_id, e.created_at, so.sellers_users_user_id,
+                    CONCAT('New order n.', so.orders_id, ' including your products')
+             from notification_outbox as e
+                      join sellers_orders as so on so.orders_id = (e.payload ->> 'order_id')::int
+             where e.event_id = any (event_ids) and e.event_type = 'sale'
+             union all
+             -- buyer of an order
+             select e.event_id, e.created_at, o.buyers_users_user_id,
+                    CONCAT('Your order n.', o.id, ' for a total of ', o.price_total, ' has been confirmed')
+             from notification_outbox as e
+                      join orders as o on o.id = (e.payload ->> 'order_id')::int
+             where e.event_id = any (event_ids) and e.event_type = 'sale'
+             union all
+             -- seller of a rated product
+             select e.event_id, e.created_at, p.sellers_users_user_id,
+                    CONCAT('Your product n.', r.products_product_id, ' (version ', r.products_version,
+                           ') has been rated a ', r.rating, ' with the comment ''', r.comment, '''')
+             from notification_outbox as e
+                      join ratings as r on r.orders_id = (e.payload ->> 'order_id')::int
+                 and r.products_product_id = (e.payload ->> 'product_id')::int
+                 and r.products_version = (e.payload ->> 'version')::timestamp
+                      join products as p on p.product_id = r.products_product_id and p.version = r.products_version
+             where e.event_id = any (event_ids) and e.event_type = 'rating'
+         ) as new_notifications
+    order by event_id;
+
+    update notification_outbox set processed_at = CURRENT_TIMESTAMP where event_id = any (event_ids);
+
+    return array_length(event_ids, 1);
+end;
+$$;
+
+
+create or replace function remove_notifications(user_ids int[], notification_ids int[], archive bool) returns int
+    language plpgsql
+as
+$$
+declare
+    moved int;
+begin
+    -- the notifications (<user_ids>[i], <notification_ids>[i]) are moved to notifications_archive, or deleted if
+    -- <archive> is false
+    with deleted as (
+        delete from notifications as n
+            using unnest(user_ids, notification_ids) as e(users_user_id, notification_id)
+            where n.users_user_id = e.users_user_id and n.notification_id = e.notification_id
+            returning n.notification_id, n.users_user_id, n.content, n.notif_time, n.read
+    ),
+         archived as (
+             insert into notifications_archive (notification_id, users_user_id, content, notif_time, read)
+                 select * from deleted where archive
+         )
+    select count(*)
+    into moved
+    from deleted;
+
+    return moved;
+end;
+$$;
+
+
+create or replace function prune_notifications(max_age interval, batch_size int, archive bool) returns int
+    language plpgsql
+as
+$$
+declare
+    user_ids         int[];
+    notification_ids int[];
+begin
+    -- one batch of the notifications older than <max_age>
+    select array_agg(users_user_id), array_agg(notification_id)
+    into user_ids, notification_ids
+    from (select users_user_id, notification_id
+          from notifications
+          where notif_time < CURRENT_TIMESTAMP - max_age
+          order by notification_id
+          limit batch_size) as expired;
+
+    return remove_notifications(user_ids, notification_ids, archive);
+end;
+$$;
+
+
+create or replace function prune_notifications_over_cap(users int[], per_user_cap int, batch_size int,
+                                                         archive bool) returns int
+    language plpgsql
+as
+$$
+declare
+    user_ids         int[];
+    notification_ids int[];
+begin
+    -- one batch of the notifications of <users> beyond the <per_user_cap> most recent of each one; each user's
+    -- notifications are walked through notifications_users_time_idx, so the cost of a batch depends on the users
+    -- given and not on the size of the table
+    select array_agg(users_user_id), array_agg(notification_id)
+    into user_ids, notification_ids
+    from (select u.users_user_id, c.notification_id
+          from unnest(users) as u(users_user_id)
+                   cross join lateral (select notification_id
+                                       from notifications
+                                       where users_user_id = u.users_user_id
+                                       order by notif_time desc, notification_id desc
+                                       offset per_user_cap) as c
+          limit batch_size) as over_cap;
+
+    return remove_notifications(user_ids, notification_ids, archive);
+end;
+$$;
+
+
+create or replace function prune_refresh_tokens(batch_size int) returns int
+    language plpgsql
+as
+$$
+declare
+    deleted int;
+begin
+    -- one batch of the expired refresh tokens (used, revoked or not: none of them can be used any more), skipping
+    -- the ones being deleted by the other api processes
+    delete
+    from refresh_tokens
+    where token_hash in (select token_hash
+                         from refresh_tokens
+                         where expires_at <= CURRENT_TIMESTAMP
+                         order by expires_at
+                         limit batch_size for update skip locked);
+
+    get diagnostics deleted = row_count;
+    return deleted;
+end;
+$$;
+
+
+create or replace function prune_notification_outbox(max_age interval, batch_size int) returns int
+    language plpgsql
+as
+$$
+declare
+    deleted int;
+begin
+    -- one batch of the events processed more than <max_age> ago
+    delete
+    from notification_outbox
+    where event_id in (select event_id
+                       from notification_outbox
+                       where processed_at < CURRENT_TIMESTAMP - max_age
+                       order by event_id
+                       limit batch_size);
+
+    get diagnostics deleted = row_count;
+    return deleted;
+end;
+$$;
+
+
+create or replace function notif_push() returns trigger
+    language plpgsql
+as
+$$
+begin
+    -- published on commit to the listeners of the 'inbox' channel (the notification streams of the api)
+    perform pg_notify('inbox', json_build_object(
+            'user_id', new.users_user_id,
+            'notification_id', new.notification_id,
+            'notif_time', to_char(new.notif_time at time zone 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US"Z"'),
+            'content', new.content)::text);
 
     return new;
 end;
@@ -146,7 +446,7 @@ $$;
 
 drop trigger if exists q_notif_trig on questions;
 create trigger q_notif_trig
-    before insert
+    after insert
     on questions
     for each row
 execute function q_notif();
@@ -162,7 +462,23 @@ execute function sale_notif();
 
 drop trigger if exists rating_notif_trig on products;
 create trigger rating_notif_trig
-    before insert
+    after insert
     on ratings
     for each row
-execute function rating_notif();
\ No newline at end of file
+execute function rating_notif();
+
+
+drop trigger if exists notif_push_trig on notifications;
+create trigger notif_push_trig
+    after insert
+    on notifications
+    for each row
+execute function notif_push();
+
+
+drop trigger if exists campaign_shards_trig on campaigns;
+create trigger campaign_shards_trig
+    after insert
+    on campaigns
+    for each row
+execute function campaign_shards();
@@ -9,6 +9,9 @@ INSERT INTO sellers VALUES (1, 503630330, 'Avenida D.João 1 Nº 270');
 INSERT INTO users VALUES (2, 'gui', crypt('tcsw', gen_salt('bf')), 'mbranco@student.dei.uc.pt');
 INSERT INTO buyers VALUES (2, 123456789, 'Praceta da Rua');
 
+INSERT INTO users VALUES (3, 'ana', crypt('anapass', gen_salt('bf')), 'ana@student.dei.uc.pt');
+INSERT INTO buyers VALUES (3, 234567891, 'Rua Larga');
+
 INSERT INTO products (product_id, version, name, price, stock, description, sellers_users_user_id) VALUES (1, '2022-04-23 23:33:00', 'Portatil Gaming Lenovo Legion 5', 1199.0, 10, 'portatil espetacular', 1);
 INSERT INTO computers VALUES (15.6, 'AMD Ryzen 5 5600H', 'NVIDIA GeForce RTX 3060', '512 GB SSD', 120, 1, '2022-04-23 23:33:00');
 
@@ -42,6 +45,12 @@ insert into ratings values ('espetaculo novo', 1, 3, 3, '2022-04-24 19:40:00', 2
 insert into campaigns values(1, 'campanha', '2022-05-10', '2022-5-17', 10, 75, 0);
 insert into coupons values(1, false, 0, '2022-06-09', 1, 2, null);
 
-insert into coupons values(2, false, 0, '2022-06-09', 1, 2, null);
+-- each buyer can only have one coupon of a campaign
+insert into coupons values(2, false, 0, '2022-06-09', 1, 3, null);
 insert into orders (id, order_date, buyers_users_user_id, coupons_coupon_id, coupons_campaigns_campaign_id)
-values (69, '2022-05-12', 2, 2, 1)
\ No newline at end of file
+values (69, '2022-05-12', 3, 2, 1);
+
+-- rows inserted with explicit ids don't advance their sequences
+select setval('users_user_id_seq', (select max(user_id) from users));
+select setval('coupons_coupon_id_seq', (select max(coupon_id) from coupons));
+select setval('campaigns_campaign_id_seq', (select max(campaign_id) from campaigns));
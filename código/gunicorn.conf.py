@@ -0,0 +1,49 @@
+"""
+gunicorn settings of the api (see wsgi.py)
+
+Each worker process serves GUNICORN_THREADS requests at a time, each one with a single connection of the worker's
+pool. The background jobs of the worker (outbox, coupon sweeper, refresh token purge and campaign cache refresh)
+take connections from the same pool, so by default the threads are the connections left for them, plus
+DBPROJ_INBOX_STREAMS threads for the notification streams (GET /dbproj/inbox/stream): an open stream holds its
+thread while its client is connected, but not a connection, and the api refuses (503) the streams beyond that
+number, so that they never take the threads of the other endpoints.
+"""
+
+import multiprocessing
+import os
+
+wsgi_app = 'wsgi:app'
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:8080')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+# connections of the pool used at the same time by the background jobs of a worker
+BACKGROUND_CONNECTIONS = 4
+
+threads = int(os.environ.get('GUNICORN_THREADS',
+                             max(1, int(os.environ.get('DBPROJ_POOL_SIZE', 10)) - BACKGROUND_CONNECTIONS) +
+                             int(os.environ.get('DBPROJ_INBOX_STREAMS', 20))))
+
+
+def on_starting(server):
+    # the metrics of the workers of a previous run aren't added up to the new ones
+    metrics_dir = os.environ.get('DBPROJ_METRICS_DIR')
+    if metrics_dir:
+        for file_name in os.listdir(metrics_dir):
+            if file_name.endswith('.json'):
+                os.remove(os.path.join(metrics_dir, file_name))
+
+
+def post_worker_init(worker):
+    import api
+    api.init_worker()
+
+
+def worker_exit(server, worker):
+    import api
+    api.shutdown_worker()
+
+
+def child_exit(server, worker):
+    # the last metrics written by the worker are kept in the file of the exited workers
+    import api
+    api.merge_exited_metrics(worker.pid)
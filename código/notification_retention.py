@@ -0,0 +1,111 @@
+"""
+Notification retention job
+
+Moves the old notifications to the notifications_archive table (or deletes them, with --delete) and deletes
+the processed events of the notification outbox, in small batches, each one in its own short transaction.
+Meant to be run periodically (e.g. by cron) from this directory:
+
+    python notification_retention.py --max-age-days 90 --per-user-cap 1000
+"""
+
+import argparse
+import logging
+import time
+import psycopg2
+from api import dedicated_connection
+
+# users whose notifications over the cap are removed by each call of prune_notifications_over_cap
+CAP_USERS_PER_CALL = 100
+
+logging.basicConfig(format='%(asctime)s [%(levelname)s]:  %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
+logger = logging.getLogger('retention')
+
+
+def run_batches(name, statement, values, pause):
+    conn = dedicated_connection()
+    cur = conn.cursor()
+
+    total = 0
+    start = time.perf_counter()
+
+    try:
+        while True:
+            cur.execute(statement, values)
+            moved = cur.fetchone()[0]
+            # committing after every batch keeps the row locks short
+            conn.commit()
+
+            if moved == 0:
+                break
+
+            total += moved
+            elapsed = time.perf_counter() - start
+            logger.info(f'{name}: {total} rows ({total / elapsed:.0f} rows/s)')
+
+            time.sleep(pause)
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'{name} - error: {error}')
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    logger.info(f'{name}: done, {total} rows in {time.perf_counter() - start:.1f}s')
+    return total
+
+
+# The users with more than <per_user_cap> notifications, found once per run (a single pass over the notifications)
+# instead of in every batch
+def users_over_cap(per_user_cap):
+    conn = dedicated_connection()
+    cur = conn.cursor()
+
+    try:
+        cur.execute('select users_user_id from notifications '
+                    'group by users_user_id having count(*) > %s order by users_user_id;', (per_user_cap,))
+        return [row[0] for row in cur.fetchall()]
+
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive or delete old notifications in small batches')
+    parser.add_argument('--max-age-days', type=int, default=None,
+                        help='notifications older than this are removed')
+    parser.add_argument('--per-user-cap', type=int, default=None,
+                        help='only the most recent notifications of each user, up to this number, are kept')
+    parser.add_argument('--outbox-max-age-days', type=int, default=7,
+                        help='processed outbox events older than this are deleted')
+    parser.add_argument('--batch-size', type=int, default=1000, help='rows removed per transaction')
+    parser.add_argument('--pause', type=float, default=0.1, help='seconds to wait between batches')
+    parser.add_argument('--delete', action='store_true', help='delete the notifications instead of archiving them')
+    args = parser.parse_args()
+
+    if args.max_age_days is None and args.per_user_cap is None:
+        parser.error('at least one of --max-age-days and --per-user-cap is required')
+
+    max_age = f'{args.max_age_days} days' if args.max_age_days is not None else None
+
+    if max_age is not None:
+        run_batches('notifications', 'select prune_notifications(%s, %s, %s);',
+                    (max_age, args.batch_size, not args.delete), args.pause)
+
+    if args.per_user_cap is not None:
+        users = users_over_cap(args.per_user_cap)
+        logger.info(f'notifications: {len(users)} users over the cap')
+
+        for i in range(0, len(users), CAP_USERS_PER_CALL):
+            run_batches(f'notifications over the cap (users {i + 1}-{min(i + CAP_USERS_PER_CALL, len(users))})',
+                        'select prune_notifications_over_cap(%s, %s, %s, %s);',
+                        (users[i:i + CAP_USERS_PER_CALL], args.per_user_cap, args.batch_size, not args.delete),
+                        args.pause)
+
+    run_batches('notification_outbox', 'select prune_notification_outbox(%s, %s);',
+                (f'{args.outbox_max_age_days} days', args.batch_size), args.pause)
+
+
+if __name__ == '__main__':
+    main()
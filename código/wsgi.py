@@ -0,0 +1,14 @@
+"""
+WSGI entry point of the api
+
+Serves the api with several worker processes, each one with its own pool of database connections and its own
+background jobs (configured in gunicorn.conf.py), from this directory:
+
+    DBPROJ_POOL_SIZE=10 gunicorn -c gunicorn.conf.py
+
+The settings are read from the DBPROJ_<name> environment variables (see DEFAULT_CONFIG in api.py).
+"""
+
+from api import create_app
+
+app = create_app()